@@ -6,25 +6,70 @@ A Dash app to display events in the 2x2 experiment
 import dash_uploader as du
 import plotly.graph_objects as go
 import atexit
+import base64
+import json
+import os
 import shutil
+import uuid
+
+import numpy as np
 
 from dash import dcc
 from dash import html
-#from dash import no_update
+from dash import Patch
+from dash import ctx
+from dash import no_update
 from dash.exceptions import PreventUpdate
 from dash_extensions.enrich import Output, DashProxy, Input, State, MultiplexerTransform
 
-from display_utils import parse_contents, create_3d_figure, plot_waveform
+from cache_utils import caches_to_prometheus
+from data_service import DataServiceClient, LocalDataSource, process_metrics
+from display_utils import (
+    is_zoomed_in,
+    layer_placeholder,
+    LIGHT_TRAPS_TRACE,
+    OPTIONAL_LAYERS,
+)
+from file_utils import FILE_POOL, RunIndex
+from timing_utils import format_timings, span, spans_to_prometheus, timed_callback
 
 from os.path import basename
 from pathlib import Path
 
 # Settings and constants
 UPLOAD_FOLDER_ROOT = "cache"
+MAX_OPEN_FILES = 4  # number of flow files kept open between callbacks
+PREFETCH_DEPTH = 2  # number of events before and after the displayed one to load
+PREFETCH_WORKERS = 2  # number of threads loading events in the background
+UPLOAD_CHUNK_SIZE = 50  # MB, larger chunks upload multi-GB files faster
+MAX_RUN_FILES = 100  # number of flow files that can be opened together as one run
+# the optional layers that are only shown when the file has them, see get_file_schema
+LAYER_REQUIREMENTS = {"segments": "has_truth", "light": "has_light"}
+# folders on the server (e.g. shared disk) with flow files that can be opened without uploading,
+# separated by os.pathsep in the EVD_DATA_FOLDERS environment variable
+DATA_FOLDERS = [Path(folder) for folder in os.environ.get("EVD_DATA_FOLDERS", "").split(os.pathsep) if folder]
+DATA_FOLDERS_REFRESH = 10  # s, how often the data folders are checked for new files
+# Unix socket of the data service (see data_service.py) to get the data from, instead of
+# reading the files in every worker process
+DATA_SERVICE = os.environ.get("EVD_DATA_SERVICE")
+TIMING_REFRESH = 2  # s, how often the timing panel is updated while it is open
+TIMING_PANEL_CALLBACKS = 10  # number of callbacks shown in the timing panel
+
+FILE_POOL.set_max_open(MAX_OPEN_FILES)
+if DATA_SERVICE:
+    DATA_SOURCE = DataServiceClient(DATA_SERVICE)
+else:
+    DATA_SOURCE = LocalDataSource(PREFETCH_DEPTH, PREFETCH_WORKERS)
+
+def layer_id(layer):
+    """Component ID of the switch of an optional layer"""
+    return "layer-" + layer.replace(" ", "-")
+
 
 # Create the app
 app = DashProxy(__name__, title="2x2 event display")
 du.configure_upload(app, UPLOAD_FOLDER_ROOT)  # without this upload will not work
+server = app.server  # for WSGI servers, e.g. gunicorn app:server
 
 # App layout
 app.layout = html.Div(
@@ -33,6 +78,12 @@ app.layout = html.Div(
         dcc.Location(id="url"),
         dcc.Store(id="filename", storage_type="local", data=None),
         dcc.Store(id='data-length', data=0),
+        # the files of the run and their number of events, see RunIndex
+        dcc.Store(id="run-index", storage_type="local", data=None),
+        dcc.Store(id='file-schema', data=None),  # what the file contains, see get_file_schema
+        # identifies the browser tab, e.g. to keep the prefetching of the users apart
+        dcc.Store(id="session-id", storage_type="session", data=None),
+        dcc.Store(id="waveform-width", data=None),  # width of the light waveform plot in pixels
         # Header
         html.H1(children="2x2 event display", style={"textAlign": "center"}),
         html.Div(children="", id="filename-div", style={"textAlign": "center"}),
@@ -40,9 +91,10 @@ app.layout = html.Div(
         html.Div(
             du.Upload(
                 id="upload-data-div",
-                text="Upload Flow HDF5 File",
+                text="Upload Flow HDF5 Files",
                 max_file_size=10000,
-                chunk_size=5,
+                max_files=MAX_RUN_FILES,
+                chunk_size=UPLOAD_CHUNK_SIZE,
                 default_style={
                     "width": "15em",
                     "padding": "0",
@@ -52,51 +104,199 @@ app.layout = html.Div(
                 filetypes=["h5"],
             ),
         ),
-        # Event ID input box
-        dcc.Input(
-                id="input-evid",
-                type="number",
-                placeholder="0",
-                debounce=True,
-                style={
-                    "width": "6em",
-                    "display": "inline-block",
-                    "margin-right": "0.5em",
-                    "margin-left": "0.5em",
-                },
+        # Open a file on the server instead
+        html.Div(
+            [
+                dcc.Dropdown(
+                    id="server-file",
+                    placeholder="Or open flow files on the server",
+                    multi=True,
+                    style={"width": "40em"},
+                ),
+                dcc.Interval(
+                    id="server-file-interval",
+                    interval=DATA_FOLDERS_REFRESH * 1000,
+                    disabled=not DATA_FOLDERS,
+                ),
+            ],
+            style={"display": "block" if DATA_FOLDERS else "none"},
+        ),
+        # Pages
+        dcc.Tabs(
+            id="page-tabs",
+            value="event",
+            children=[
+                dcc.Tab(label="Event display", value="event"),
+                dcc.Tab(label="Run overview", value="overview"),
+            ],
+        ),
+        html.Div(
+            [
+                # Event ID input box
+                dcc.Input(
+                        id="input-evid",
+                        type="number",
+                        placeholder="0",
+                        debounce=True,
+                        style={
+                            "width": "6em",
+                            "display": "inline-block",
+                            "margin-right": "0.5em",
+                            "margin-left": "0.5em",
+                        },
+                    ),
+                # Event ID buttons
+                html.Button('Previous Event', id='prev-button', n_clicks=0),
+                html.Button('Next Event', id='next-button', n_clicks=0),
+                # Only step through the events that pass these filters
+                html.Div(
+                    [
+                        dcc.Input(id="filter-min-hits", type="number", min=0, placeholder="min hits", debounce=True, style={"width": "7em"}),
+                        dcc.Input(id="filter-min-energy", type="number", min=0, placeholder="min E [MeV]", debounce=True, style={"width": "7em"}),
+                        dcc.Checklist(
+                            id="filter-flags",
+                            options=[
+                                {"label": "with light", "value": "light"},
+                                {"label": "with truth", "value": "truth"},
+                            ],
+                            value=[],
+                            inline=True,
+                        ),
+                        html.Span(id="filter-div"),
+                    ],
+                    style={"display": "flex", "gap": "0.5em", "margin": "0.5em"},
+                ),
+                dcc.Store(id='event-id', data=0),
+                dcc.Store(id='full-resolution', data=False),
+                dcc.Store(id='figure-file', data=None),  # file of the figure shown in the 3D graph
+                dcc.Store(id='light-trap-opids', data=None),  # opid of every corner of the light traps
+                dcc.Store(id='waveform-opid', data=None),  # the clicked optical detector
+                html.Div(id='evid-div', style={"textAlign": "center"}),
+                # Graphs
+                html.Div([
+                    # Existing 3D graph
+                    html.Div([
+                        # the optional layers are only loaded when they are switched on
+                        html.Div(
+                            [
+                                dcc.Checklist(
+                                    id=layer_id(layer),
+                                    options=[{"label": layer, "value": layer}],
+                                    value=[],
+                                    inline=True,
+                                )
+                                for layer in OPTIONAL_LAYERS
+                            ],
+                            style={"display": "flex", "gap": "1em"},
+                        ),
+                        dcc.Graph(id='3d-graph', style={'height': '70vh', 'width': '50vw'}),
+                    ]),
+
+                    # New Light waveform graph
+                    html.Div(
+                        [
+                            # which optical detectors to show around the clicked one, and how
+                            dcc.RadioItems(
+                                id="waveform-channels",
+                                options=[
+                                    {"label": "detector", "value": "detector"},
+                                    {"label": "tpc", "value": "tpc"},
+                                    {"label": "module", "value": "module"},
+                                ],
+                                value="detector",
+                                inline=True,
+                            ),
+                            dcc.RadioItems(
+                                id="waveform-layout",
+                                options=[
+                                    {"label": "overlay", "value": "overlay"},
+                                    {"label": "stack", "value": "stack"},
+                                ],
+                                value="overlay",
+                                inline=True,
+                            ),
+                            dcc.Graph(id="light-waveform", style={'height': '50vh', 'width': '35vw'}),
+                        ],
+                        id="light-waveform-div",
+                    ),
+
+
+                ], style={'display': 'flex'}),
+                # New Another Graph (replace with your actual component)
+                html.Div(dcc.Graph(id="another-graph", style={'height': '30vh', 'width': '35vw', 'float': 'right'})),
+            ],
+            id="event-page",
+        ),
+        # Data quality views of the whole file, computed when the tab is opened
+        html.Div(
+            dcc.Loading(
+                [
+                    dcc.Store(id="overview-file", data=None),  # file of the shown overview
+                    dcc.Graph(id="overview-occupancy", style={"height": "60vh"}),
+                    html.Div(
+                        [
+                            dcc.Graph(id="overview-light", style={"height": "45vh", "width": "33vw"}),
+                            dcc.Graph(id="overview-rate", style={"height": "45vh", "width": "33vw"}),
+                            dcc.Graph(id="overview-charge-light", style={"height": "45vh", "width": "33vw"}),
+                        ],
+                        style={"display": "flex"},
+                    ),
+                ]
             ),
-        # Event ID buttons
-        html.Button('Previous Event', id='prev-button', n_clicks=0),
-        html.Button('Next Event', id='next-button', n_clicks=0),
-        dcc.Store(id='event-id', data=0),
-        html.Div(id='evid-div', style={"textAlign": "center"}),
-        # Graphs
-        html.Div([
-            # Existing 3D graph
-            html.Div(dcc.Graph(id='3d-graph', style={'height': '70vh', 'width': '50vw'})),
-
-            # New Light waveform graph
-            html.Div(dcc.Graph(id="light-waveform", style={'height': '50vh', 'width': '35vw'})),
-
-            
-        ], style={'display': 'flex'}),
-        # New Another Graph (replace with your actual component)
-        html.Div(dcc.Graph(id="another-graph", style={'height': '30vh', 'width': '35vw', 'float': 'right'})),
+            id="overview-page",
+            style={"display": "none"},
+        ),
+        # Timing of the last callbacks
+        html.Details(
+            [
+                html.Summary("Timing"),
+                html.Pre(id="timing-panel", style={"fontSize": "small"}),
+                dcc.Interval(id="timing-interval", interval=TIMING_REFRESH * 1000, disabled=True),
+            ],
+            id="timing-details",
+            open=False,
+            style={"clear": "both"},
+        ),
     ]
 )
 
 
+# Metrics for monitoring, in the Prometheus text format
+@app.server.route("/metrics")
+def metrics():
+    processes = {"worker": process_metrics()}
+    if DATA_SERVICE:
+        processes["service"] = DATA_SOURCE.metrics()
+    text = spans_to_prometheus({process: m["spans"] for process, m in processes.items()})
+    text += caches_to_prometheus({process: m["caches"] for process, m in processes.items()})
+    return text, 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
 # Callbacks
 
 
+@app.callback(
+    Output("session-id", "data"),
+    Input("url", "pathname"),
+    State("session-id", "data"),
+)
+def start_session(pathname, session_id):
+    """Give every browser tab its own ID"""
+    if session_id is not None:
+        raise PreventUpdate
+    return uuid.uuid4().hex
+
+
 # Callback to handle the upload
 # =============================
 @app.callback(
     [
-        Output("filename", "data"),
-        Output("filename-div", "children"),
+        Output("filename", "data", allow_duplicate=True),
+        Output("filename-div", "children", allow_duplicate=True),
         Output("event-id", "data", allow_duplicate=True),
-        Output('data-length', 'data'),
+        Output('data-length', 'data', allow_duplicate=True),
+        Output('file-schema', 'data', allow_duplicate=True),
+        Output("run-index", "data", allow_duplicate=True),
     ],
     [
         Input("upload-data-div", "isCompleted"),
@@ -108,121 +308,568 @@ app.layout = html.Div(
     ],
     prevent_initial_call=True
 )
+@timed_callback
 def upload_file(is_completed, current_filename, filenames, upload_id):
     """
-    Upload HDF5 file to cache. If the upload is completed,
-    update the filename. Initialise the event ID to 0.
+    Upload HDF5 files to cache. If the upload is completed, open
+    the files as one run. Initialise the event ID to 0.
     """
     if not is_completed:
         raise PreventUpdate
 
-    if filenames is not None:
+    if filenames:
         if upload_id:
             root_folder = Path(UPLOAD_FOLDER_ROOT) / upload_id
         else:
             root_folder = Path(UPLOAD_FOLDER_ROOT)
-        _, num_events = parse_contents(str(root_folder / filenames[0]))
-        new_filename = str(root_folder / filenames[0])
-        return new_filename, basename(filenames[0]), 0, num_events
+        return open_run([str(root_folder / filename) for filename in filenames])
+
+    return current_filename, "no file uploaded", 0, 0, None, None
+
+
+# Callbacks to open files on the server
+# =====================================
+@app.callback(
+    Output("server-file", "options"),
+    Input("server-file-interval", "n_intervals"),
+)
+def list_server_files(n_intervals):
+    """List the flow files in the data folders"""
+    options = []
+    for folder in DATA_FOLDERS:
+        for path in sorted(folder.rglob("*.h5")):
+            options.append({"label": str(path.relative_to(folder)), "value": str(path)})
+    return options
+
+
+@app.callback(
+    [
+        Output("filename", "data", allow_duplicate=True),
+        Output("filename-div", "children", allow_duplicate=True),
+        Output("event-id", "data", allow_duplicate=True),
+        Output('data-length', 'data', allow_duplicate=True),
+        Output('file-schema', 'data', allow_duplicate=True),
+        Output("run-index", "data", allow_duplicate=True),
+    ],
+    Input("server-file", "value"),
+    prevent_initial_call=True
+)
+@timed_callback
+def open_server_file(paths):
+    """
+    Open files from the data folders in place, without copying them to the cache.
+    Initialise the event ID to 0.
+    """
+    paths = [path for path in paths or [] if is_in_data_folder(path)]
+    if not paths:
+        raise PreventUpdate
+    return open_run(paths)
+
+
+def open_run(paths):
+    """
+    Open flow files as one run, in the order of their names, and go to its first
+    event. Only the number of events of every file is read here, the files are
+    opened again from the pool when their events are displayed.
+    """
+    paths = sorted(paths)
+    run = RunIndex(paths, [DATA_SOURCE.num_events(path) for path in paths])
+    filename, evid = run.locate(0)
+    return (
+        filename,
+        file_label(run, filename),
+        evid,
+        run.num_events[run.filenames.index(filename)],
+        DATA_SOURCE.schema(filename),
+        run.to_dict(),
+    )
+
+
+def get_run(run_data, filename, num_events):
+    """The run of the displayed file, or a run of only that file"""
+    if run_data is None or filename not in run_data["filenames"]:
+        return RunIndex([filename], [num_events])
+    return RunIndex(**run_data)
+
 
-    return current_filename, "no file uploaded", 0, 0
+def file_label(run, filename):
+    if len(run.filenames) == 1:
+        return basename(filename)
+    i = run.filenames.index(filename)
+    return f"{basename(filename)} (file {i + 1}/{len(run.filenames)})"
 
 
+def is_in_data_folder(path):
+    """Only files in the data folders can be opened from the server"""
+    path = Path(path).resolve()
+    return path.is_file() and any(
+        folder.resolve() in path.parents for folder in DATA_FOLDERS
+    )
+
+
+
+@app.callback(
+    Output('light-waveform-div', 'style'),
+    *[Output(layer_id(layer), 'style') for layer in LAYER_REQUIREMENTS],
+    Input('file-schema', 'data'),
+)
+def show_available_layers(schema):
+    """Hide the views of what is not in the file, e.g. the light waveforms of a charge-only file"""
+    if schema is None:
+        return {}, *[{} for _ in LAYER_REQUIREMENTS]
+    return (
+        {} if schema['has_light'] else {'display': 'none'},
+        *[{} if schema[key] else {'display': 'none'} for key in LAYER_REQUIREMENTS.values()],
+    )
+
 
 # Callbacks to handle the event ID
 # =================================
-@app.callback(
+def get_filters(min_hits, min_energy, flags):
+    """The event filters as keyword arguments of select_events, or None without filters"""
+    filters = {
+        "min_hits": min_hits,
+        "min_energy": min_energy,
+        "with_light": "light" in (flags or []),
+        "with_truth": "truth" in (flags or []),
+    }
+    if not any(filters.values()):
+        return None
+    return filters
+
+
+def step_filtered(run, filename, evid, step, filters):
+    """
+    Go to the next or previous event that passes the filters, continuing in the
+    next or previous file of the run when no event is left in this one
+    """
+    if filename is None:
+        raise PreventUpdate
+    current_filename = filename
+    n_files = len(run.filenames)
+    i = run.filenames.index(filename)
+    new_evid = DATA_SOURCE.next_event(filename, evid, step, filters, n_files == 1)
+    for k in range(1, n_files + 1):
+        if new_evid is not None:
+            break
+        # search the files from their first (step 1) or last (step -1) event
+        filename = run.filenames[(i + k * step) % n_files]
+        start = -1 if step > 0 else run.num_events[(i + k * step) % n_files]
+        new_evid = DATA_SOURCE.next_event(filename, start, step, filters, False)
+    if new_evid is None:
+        raise PreventUpdate  # no event passes the filters
+    return go_to_event(run, run.global_evid(filename, new_evid), current_filename)
+
+
+def go_to_event(run, evid, current_filename):
+    """
+    Show an event of the run by its global event ID. The file, its number of
+    events and its schema only change when the event is in another file.
+    """
+    filename, local_evid = run.locate(evid)
+    if filename == current_filename:
+        return no_update, no_update, local_evid, no_update, no_update
+    return (
+        filename,
+        file_label(run, filename),
+        local_evid,
+        run.num_events[run.filenames.index(filename)],
+        DATA_SOURCE.schema(filename),
+    )
+
+
+NAVIGATION_OUTPUTS = [
+    Output("filename", "data", allow_duplicate=True),
+    Output("filename-div", "children", allow_duplicate=True),
     Output('event-id', 'data', allow_duplicate=True),
+    Output('data-length', 'data', allow_duplicate=True),
+    Output('file-schema', 'data', allow_duplicate=True),
+]
+
+
+@app.callback(
+    *NAVIGATION_OUTPUTS,
     Input('next-button', 'n_clicks'),
     State('event-id', 'data'),
     State('data-length', 'data'),
+    State('filename', 'data'),
+    State('run-index', 'data'),
+    State('filter-min-hits', 'value'),
+    State('filter-min-energy', 'value'),
+    State('filter-flags', 'value'),
     prevent_initial_call=True
 )
-def increment(n, evid, max_value):
-    if n > 0:
-        new_evid = evid + 1
-        if new_evid > max_value:  # wrap around
-            return 0
-        else:
-            return new_evid
+@timed_callback
+def increment(n, evid, max_value, filename, run_data, min_hits, min_energy, flags):
+    if n == 0 or filename is None:
+        raise PreventUpdate
+    run = get_run(run_data, filename, max_value)
+    filters = get_filters(min_hits, min_energy, flags)
+    if filters is not None:
+        return step_filtered(run, filename, evid, 1, filters)
+    new_evid = run.global_evid(filename, evid) + 1
+    if new_evid >= len(run):  # wrap around
+        new_evid = 0
+    return go_to_event(run, new_evid, filename)
 
 @app.callback(
-    Output('event-id', 'data', allow_duplicate=True),
+    *NAVIGATION_OUTPUTS,
     Input('prev-button', 'n_clicks'),
     State('event-id', 'data'),
     State('data-length', 'data'),
+    State('filename', 'data'),
+    State('run-index', 'data'),
+    State('filter-min-hits', 'value'),
+    State('filter-min-energy', 'value'),
+    State('filter-flags', 'value'),
     prevent_initial_call=True
 )
-def decrement(n, evid, max_value):
-    if n > 0:
-        if evid > 0:
-            return evid - 1
-        return max_value - 1 # wrap around
+@timed_callback
+def decrement(n, evid, max_value, filename, run_data, min_hits, min_energy, flags):
+    if n == 0 or filename is None:
+        raise PreventUpdate
+    run = get_run(run_data, filename, max_value)
+    filters = get_filters(min_hits, min_energy, flags)
+    if filters is not None:
+        return step_filtered(run, filename, evid, -1, filters)
+    new_evid = run.global_evid(filename, evid) - 1
+    if new_evid < 0:  # wrap around
+        new_evid = len(run) - 1
+    return go_to_event(run, new_evid, filename)
 
 @app.callback(
-    Output('event-id', 'data', allow_duplicate=True),
+    *NAVIGATION_OUTPUTS,
     Input('input-evid', 'value'),
     State('data-length', 'data'),
+    State('filename', 'data'),
+    State('run-index', 'data'),
     prevent_initial_call=True
 )
-def set_evid(value, max_value):
-    if value is not None:
-        if value > max_value:  # not possible to go higher than max value
-            return max_value
-        else:
-            return value
+def set_evid(value, max_value, filename, run_data):
+    """Go to an event by its event ID in the run"""
+    if value is None or filename is None:
+        raise PreventUpdate
+    run = get_run(run_data, filename, max_value)
+    # not possible to go higher than the last event
+    return go_to_event(run, min(max(value, 0), len(run) - 1), filename)
+
+@app.callback(
+    Output('filter-div', 'children'),
+    Input('filter-min-hits', 'value'),
+    Input('filter-min-energy', 'value'),
+    Input('filter-flags', 'value'),
+    Input('filename', 'data'),
+    State('run-index', 'data'),
+)
+def update_filter_div(min_hits, min_energy, flags, filename, run_data):
+    filters = get_filters(min_hits, min_energy, flags)
+    if filters is None or filename is None:
+        return ""
+    count = DATA_SOURCE.count_events(filename, filters)
+    if run_data is not None and len(run_data["filenames"]) > 1:
+        # summarising every file of the run takes a pass over each of them
+        return f"{count} events in this file pass the filters"
+    return f"{count} events pass the filters"
 
 @app.callback(
     Output('evid-div', 'children'),
     Input('event-id', 'data'),
+    Input('filename', 'data'),
     State('data-length', 'data'),
+    State('run-index', 'data'),
 )
-def update_div(evid, max_value):
-    return f'Event ID: {evid}/{max_value}'
+def update_div(evid, filename, max_value, run_data):
+    if filename is None:
+        return f'Event ID: {evid}/{max_value}'
+    run = get_run(run_data, filename, max_value)
+    return f'Event ID: {run.global_evid(filename, evid)}/{len(run)}'
 
 # Callback to display the event
 # =============================
 @app.callback(
     Output('3d-graph', 'figure'),
+    Output('figure-file', 'data'),
+    Output('light-trap-opids', 'data'),
     Input('filename', 'data'),
     Input('event-id', 'data'),
+    Input('full-resolution', 'data'),
+    State('figure-file', 'data'),
+    State('data-length', 'data'),
+    State('run-index', 'data'),
+    State('session-id', 'data'),
+    *[State(layer_id(layer), 'value') for layer in OPTIONAL_LAYERS],
     prevent_initial_call=True
 )
-def update_graph(filename, evid):
-    if filename is not None:
-        data, _ = parse_contents(filename)
-        return create_3d_figure(data, evid)
-    
+@timed_callback
+def update_graph(filename, evid, full_resolution, figure_file, num_events, run_data, session_id, *layer_values):
+    if filename is None:
+        raise PreventUpdate
+    layers = [layer for value in layer_values for layer in value]
+    if figure_file == filename:
+        # the detector geometry is already shown, only send the prompt hits,
+        # the optional layers are updated by their own callbacks
+        options = {"full_resolution": full_resolution}
+    else:
+        options = {"full_resolution": full_resolution, "layers": layers}
+    figure_json = DATA_SOURCE.figure_json(filename, evid, options)
+    with span("figure parsing"):
+        fig = json.loads(figure_json)
+    # the light trap corners only change with the detector geometry
+    light_trap_opids = fig['data'][LIGHT_TRAPS_TRACE].get('customdata')
+    if figure_file == filename:
+        fig = patch_trace(Patch(), 0, fig['data'][0])
+        light_trap_opids = no_update
+    # load the events we are likely to show next in the background, also across the
+    # ends of the file when it is part of a run
+    run = get_run(run_data, filename, num_events)
+    DATA_SOURCE.prefetch(run.to_dict(), run.global_evid(filename, evid), layers, session_id)
+    return fig, filename, light_trap_opids
+
+
+# what changes per event in the traces of the 3D figure
+EVENT_TRACE_KEYS = [
+    ['x', 'y', 'z', 'marker.color'],  # prompt hits
+    ['x', 'y', 'z', 'marker.color', 'showlegend'],  # final hits
+    ['x', 'y', 'z', 'showlegend'],  # segments
+    ['facecolor', 'text', 'visible'],  # light traps
+]
+
+
+def patch_trace(patch, i, trace):
+    """
+    Update trace i of the displayed 3D figure to the given trace with a Patch, which only
+    sends what changes per event. The geometry and the camera stay as they are.
+    """
+    for key in EVENT_TRACE_KEYS[i]:
+        if key == 'marker.color':
+            if 'marker' in trace:
+                patch['data'][i]['marker']['color'] = trace['marker']['color']
+        elif key in trace:
+            patch['data'][i][key] = trace[key]
+    return patch
+
+
+def make_layer_callback(layer):
+    """
+    Callback that loads an optional layer when it is switched on, and updates it
+    when the event changes while it is on.
+    """
+    i = OPTIONAL_LAYERS[layer]
+    inputs = [Input('event-id', 'data'), Input(layer_id(layer), 'value')]
+    if layer == "final hits":
+        inputs.append(Input('full-resolution', 'data'))
+
+    def update_layer(evid, value, *args):
+        *full_resolution, filename, figure_file = args
+        if filename is None or figure_file != filename:
+            # the figure of this file is not shown yet, update_graph adds the layer
+            raise PreventUpdate
+        switched = ctx.triggered_id == layer_id(layer)
+        if layer not in (value or []):
+            if not switched:
+                raise PreventUpdate
+            return patch_layer(i, layer_placeholder(layer)), no_update
+
+        options = {"full_resolution": full_resolution[0]} if full_resolution else {}
+        trace = json.loads(DATA_SOURCE.layer_json(filename, evid, layer, options))
+        if not switched:
+            return patch_trace(Patch(), i, trace), no_update
+        light_trap_opids = trace.get('customdata') if layer == "light" else no_update
+        return patch_layer(i, trace), light_trap_opids
+
+    update_layer.__name__ = f"update_{layer_id(layer).replace('-', '_')}"
+    return app.callback(
+        Output('3d-graph', 'figure', allow_duplicate=True),
+        Output('light-trap-opids', 'data', allow_duplicate=True),
+        *inputs,
+        State('filename', 'data'),
+        State('figure-file', 'data'),
+        prevent_initial_call=True
+    )(timed_callback(update_layer))
+
+
+def patch_layer(i, trace):
+    """Replace trace i of the displayed 3D figure"""
+    patch = Patch()
+    patch['data'][i] = trace
+    return patch
+
+
+for _layer in OPTIONAL_LAYERS:
+    make_layer_callback(_layer)
+
+
 @app.callback(
-    Input('filename', 'data'),
-    Input('event-id', 'data'),
-    Input('3d-graph', 'figure'),
+    Output('full-resolution', 'data'),
+    Input('3d-graph', 'relayoutData'),
+    State('full-resolution', 'data'),
+    prevent_initial_call=True
+)
+def update_resolution(relayout_data, full_resolution):
+    """Show all the hits when zoomed in, and merged hits for dense events otherwise"""
+    if not relayout_data or 'scene.camera' not in relayout_data:
+        raise PreventUpdate
+    zoomed_in = is_zoomed_in(relayout_data['scene.camera'])
+    if zoomed_in == full_resolution:
+        raise PreventUpdate
+    return zoomed_in
+
+@app.callback(
+    Output('waveform-opid', 'data'),
     Input('3d-graph', 'clickData'),
+    State('light-trap-opids', 'data'),
+    prevent_initial_call=True
+)
+def select_light_trap(click_data, light_trap_opids):
+    """Find the optical detector of a clicked light trap"""
+    if not click_data:
+        raise PreventUpdate
+    point = click_data["points"][0]
+    if int(point["curveNumber"]) != LIGHT_TRAPS_TRACE:
+        raise PreventUpdate  # not a light trap
+    # the light traps are one mesh, every corner has the opid as customdata
+    if "customdata" in point:
+        return int(point["customdata"])
+    if light_trap_opids is None:
+        raise PreventUpdate
+    return int(decode_array(light_trap_opids)[int(point["pointNumber"])])
+
+
+def decode_array(array):
+    """Decode an array from a figure, which may be a list or a base64 typed array"""
+    if isinstance(array, dict):
+        return np.frombuffer(base64.b64decode(array["bdata"]), dtype=array["dtype"])
+    return np.asarray(array)
+
+
+def get_waveform_opids(opid, channels):
+    """The optical detectors to show: the clicked one, or all of its tpc or module"""
+    if channels == "tpc":
+        return list(range(opid - opid % 48, opid - opid % 48 + 48))
+    if channels == "module":
+        return list(range(opid - opid % 96, opid - opid % 96 + 96))
+    return [opid]
+
+
+# the waveforms are decimated to the width of the plot, which is only known in the browser
+app.clientside_callback(
+    """
+    function(opid, width) {
+        var graph = document.getElementById("light-waveform");
+        var pixels = graph ? Math.round(graph.getBoundingClientRect().width) : 0;
+        if (pixels <= 0 || pixels === width) {
+            return window.dash_clientside.no_update;
+        }
+        return pixels;
+    }
+    """,
+    Output('waveform-width', 'data'),
+    Input('waveform-opid', 'data'),
+    State('waveform-width', 'data'),
+)
+
+
+@app.callback(
     Output('light-waveform', 'figure'),
+    Input('filename', 'data'),
+    Input('event-id', 'data'),
+    Input('waveform-opid', 'data'),
+    Input('waveform-channels', 'value'),
+    Input('waveform-layout', 'value'),
+    Input('waveform-width', 'data'),
+)
+@timed_callback
+def update_light_waveform(filename, evid, opid, channels, layout, width):
+    if filename is None or opid is None:
+        return go.Figure()
+    opids = get_waveform_opids(opid, channels)
+    figure_json = DATA_SOURCE.waveform_json(filename, evid, opids, layout == "stack", width)
+    if figure_json is None:
+        return go.Figure()
+    return json.loads(figure_json)
+
+
+# Callbacks for the run overview
+# ==============================
+@app.callback(
+    Output('event-page', 'style'),
+    Output('overview-page', 'style'),
+    Input('page-tabs', 'value'),
 )
-def update_light_waveform(filename, evid, graph, click_data):
-    if click_data:
-        curvenum = int(click_data["points"][0]["curveNumber"])
-        print(curvenum) # this is the curve number from the clickdata of the graph
-        opid = int(graph['data'][curvenum]['ids'][0][0].split('_')[1])
-        print(opid) # the opid related to the curvenumber
-        if filename is not None:
-            data, _ = parse_contents(filename)
-            return plot_waveform(data, evid, opid)
-    return go.Figure()
+def show_page(tab):
+    if tab == "overview":
+        return {'display': 'none'}, {'display': 'block'}
+    return {'display': 'block'}, {'display': 'none'}
+
+
+@app.callback(
+    Output('overview-occupancy', 'figure'),
+    Output('overview-light', 'figure'),
+    Output('overview-rate', 'figure'),
+    Output('overview-charge-light', 'figure'),
+    Output('overview-file', 'data'),
+    Input('page-tabs', 'value'),
+    Input('filename', 'data'),
+    State('overview-file', 'data'),
+)
+@timed_callback
+def update_overview(tab, filename, overview_file):
+    """Compute the overview of the file the first time its tab is opened"""
+    if tab != "overview" or filename is None or filename == overview_file:
+        raise PreventUpdate
+    figures = json.loads(DATA_SOURCE.overview_json(filename))
+    return (
+        figures["occupancy"],
+        figures["light"],
+        figures["rate"],
+        figures["charge-light"],
+        filename,
+    )
+
+
+# Callbacks for the timing panel
+# ==============================
+@app.callback(
+    Output('timing-interval', 'disabled'),
+    Input('timing-details', 'open'),
+)
+def toggle_timing_panel(is_open):
+    """Only update the timing panel while it is open"""
+    return not is_open
+
+
+@app.callback(
+    Output('timing-panel', 'children'),
+    Input('timing-interval', 'n_intervals'),
+    Input('timing-details', 'open'),
+    prevent_initial_call=True
+)
+def update_timing_panel(n_intervals, is_open):
+    if not is_open:
+        raise PreventUpdate
+    return format_timings(TIMING_PANEL_CALLBACKS)
 
 
 # Cleaning up
 # ===========
-@atexit.register
 def clean_cache():
-    """Delete uploaded files"""
+    """Stop prefetching, close the open files and delete uploaded files"""
+    DATA_SOURCE.close()
+    if DATA_SERVICE:
+        return  # the uploads are shared with the other workers, the service removes them
     try:
         shutil.rmtree(Path(UPLOAD_FOLDER_ROOT))
     except OSError as err:
         print("Can't clean %s : %s" % (UPLOAD_FOLDER_ROOT, err.strerror))
 
 
+# only the process serving the app cleans up: the processes it spawns, e.g. for the run
+# overview, import this module again as __mp_main__ and would remove the uploads when
+# they exit
+if __name__ != "__mp_main__":
+    atexit.register(clean_cache)
+
+
 # Run the app
 if __name__ == "__main__":
     app.run(debug=True, port=8080)
\ No newline at end of file
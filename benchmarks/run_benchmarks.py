@@ -0,0 +1,246 @@
+"""
+Time the display hot paths on a synthetic flow file. Run with:
+``python -m benchmarks.run_benchmarks --events 20 --hits 10000 --light-events 100000``
+Use --output to store the results and --compare to check them against stored results.
+"""
+import argparse
+import json
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import plotly.io as pio
+
+import display_utils
+import file_utils
+from benchmarks.synthetic import TRUTH_DATASET, make_flow_file
+from display_utils import (
+    OPTIONAL_LAYERS,
+    SEGMENT_FIELDS,
+    create_3d_figure,
+    get_event_segments,
+    get_waveforms_all_detectors,
+    match_light_to_charge_event,
+    parse_contents,
+    plot_light_traps,
+    plot_waveform,
+)
+from file_utils import FILE_POOL, get_file_schema, open_flow_file
+
+
+def clear_caches():
+    """Forget everything that was loaded, to time the first display of an event"""
+    display_utils.EVENT_CACHE.clear()
+    display_utils.LIGHT_CACHE.clear()
+    display_utils.SEGMENT_CACHE.clear()
+
+
+def measure(function, evids, repeat, cold=True):
+    """
+    Call function(evid) for every event, repeat times.
+    Returns the timing statistics per call and the peak memory.
+    """
+    times = []
+    if not cold:
+        for evid in evids:
+            function(evid)  # fill the caches first
+    tracemalloc.start()
+    for _ in range(repeat):
+        for evid in evids:
+            if cold:
+                clear_caches()
+            start = time.perf_counter()
+            function(evid)
+            times.append(time.perf_counter() - start)
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "min_ms": 1000 * min(times),
+        "median_ms": 1000 * statistics.median(times),
+        "mean_ms": 1000 * statistics.mean(times),
+        "calls": len(times),
+        "peak_traced_mb": peak_traced / 1024**2,
+        # the peak RSS of the process so far, in kB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_benchmarks(filename, evids, repeat):
+    results = {}
+
+    def reopen(evid):
+        FILE_POOL.close(filename)
+        parse_contents(filename)
+
+    results["parse_contents"] = measure(reopen, evids[:1], repeat)
+
+    with open_flow_file(filename) as data:
+        # build the per-file light tables once, they are not part of the per-event cost
+        match_light_to_charge_event(data, evids[0])
+        matches = {evid: match_light_to_charge_event(data, evid) for evid in evids}
+        light_evids = [evid for evid in evids if matches[evid] is not None]
+        n_opids = len(display_utils.SIPM_CHANNELS)
+
+        results["match_light_to_charge_event"] = measure(
+            lambda evid: match_light_to_charge_event(data, evid), evids, repeat
+        )
+        if light_evids:
+            results["get_waveforms_all_detectors"] = measure(
+                lambda evid: get_waveforms_all_detectors(data, matches[evid]),
+                light_evids,
+                repeat,
+            )
+            integral = np.random.default_rng(0).uniform(0, 1e6, n_opids)
+            results["plot_light_traps"] = measure(
+                lambda evid: plot_light_traps(data, integral, np.arange(n_opids), integral.max()),
+                light_evids,
+                repeat,
+            )
+            results["plot_waveform"] = measure(
+                lambda evid: plot_waveform(data, evid, 0), light_evids, repeat
+            )
+        results["create_3d_figure"] = measure(
+            lambda evid: create_3d_figure(data, evid, layers=OPTIONAL_LAYERS), evids, repeat
+        )
+        results["create_3d_figure (cached data)"] = measure(
+            lambda evid: create_3d_figure(data, evid, layers=OPTIONAL_LAYERS),
+            evids,
+            repeat,
+            cold=False,
+        )
+        results["create_3d_figure (prompt hits only)"] = measure(
+            lambda evid: create_3d_figure(data, evid), evids, repeat
+        )
+        sizes = [
+            len(pio.to_json(create_3d_figure(data, evid, layers=OPTIONAL_LAYERS), validate=False))
+            for evid in evids
+        ]
+        results["create_3d_figure"]["figure_json_mb"] = max(sizes) / 1024**2
+        if light_evids:
+            sizes = [
+                len(pio.to_json(plot_waveform(data, evid, 0), validate=False))
+                for evid in light_evids
+            ]
+            results["plot_waveform"]["figure_json_mb"] = max(sizes) / 1024**2
+
+    return results
+
+
+def check_segment_lookup(filename, evids):
+    """
+    Check the segments found by get_event_segments against dereferencing the
+    events -> hits -> packets -> segments chain per event. Returns the events
+    for which they differ.
+    """
+    truth_dataset = get_file_schema(filename).truth_dataset
+    if truth_dataset is None:
+        return []
+    mismatches = []
+    with open_flow_file(filename) as data:
+        for evid in evids:
+            # the first segment of the first packet of every hit
+            chain = data[
+                "charge/events", "charge/calib_prompt_hits", "charge/packets", truth_dataset, evid
+            ][0, :, 0, 0]
+            valid = ~np.ma.getmaskarray(chain[SEGMENT_FIELDS[0]])
+            expected = np.stack([np.asarray(chain[field])[valid] for field in SEGMENT_FIELDS], 1)
+            display_utils.SEGMENT_CACHE.clear()
+            segments = get_event_segments(data, evid)
+            found = np.stack([segments[field] for field in SEGMENT_FIELDS], 1)
+            if not np.array_equal(np.unique(expected, axis=0), np.unique(found, axis=0)):
+                mismatches.append(evid)
+    return mismatches
+
+
+def print_results(results, baseline=None):
+    print(f"{'benchmark':40s} {'median [ms]':>12s} {'min [ms]':>10s} {'peak [MB]':>10s}", end="")
+    print(f" {'vs baseline':>12s}" if baseline else "")
+    for name, result in results.items():
+        line = (
+            f"{name:40s} {result['median_ms']:12.2f} {result['min_ms']:10.2f}"
+            f" {result['peak_traced_mb']:10.1f}"
+        )
+        if baseline and name in baseline:
+            line += f" {result['median_ms'] / baseline[name]['median_ms']:11.2f}x"
+        print(line)
+
+
+def find_regressions(results, baseline, threshold):
+    """Benchmarks that got slower than threshold times their baseline"""
+    return [
+        name
+        for name, result in results.items()
+        if name in baseline and result["median_ms"] > threshold * baseline[name]["median_ms"]
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--events", type=int, default=10)
+    parser.add_argument("--hits", type=int, default=10000, help="hits per event")
+    parser.add_argument("--segments", type=int, default=1000, help="truth segments per event")
+    parser.add_argument("--light-per-event", type=int, default=2)
+    parser.add_argument("--light-events", type=int, default=10000, help="total light events")
+    parser.add_argument("--layout", choices=list(TRUTH_DATASET), default="minirun4")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--file", help="use this flow file instead of a synthetic one")
+    parser.add_argument("--output", help="store the results in this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="slowdown compared to --compare that counts as a regression",
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # keep the sidecar files of the benchmark out of the app cache
+        file_utils.SIDECAR_FOLDER = tmp_dir
+        filename = args.file
+        if filename is None:
+            filename = str(Path(tmp_dir) / "synthetic.h5")
+            print(f"Generating {filename}")
+            make_flow_file(
+                filename,
+                n_events=args.events,
+                hits_per_event=args.hits,
+                segments_per_event=args.segments,
+                light_per_event=args.light_per_event,
+                n_light_events=args.light_events,
+                layout=args.layout,
+            )
+        _, num_events = parse_contents(filename)
+        evids = list(range(min(args.events, num_events)))
+        results = run_benchmarks(filename, evids, args.repeat)
+        mismatches = check_segment_lookup(filename, evids)
+        FILE_POOL.close_all()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+
+    if mismatches:
+        print(f"The segment lookup differs from the reference chain for events {mismatches}")
+        return 1
+    if baseline:
+        regressions = find_regressions(results, baseline, args.threshold)
+        if regressions:
+            print(f"Regressions: {regressions}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
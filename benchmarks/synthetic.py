@@ -0,0 +1,230 @@
+"""
+Generate synthetic flow files with the h5flow layout used by the display, for benchmarks.
+Run with:
+``python -m benchmarks.synthetic FILE --events 100 --hits 10000 --light-events 100000``
+"""
+import argparse
+
+import h5py
+import numpy as np
+
+# h5flow stores references as (parent index, child index) pairs, with for every row of
+# both datasets the range of reference rows that point to it
+REF_DTYPE = np.dtype("u8")
+REF_REGION_DTYPE = np.dtype([("start", "i8"), ("stop", "i8")])
+
+EVENTS_DTYPE = np.dtype([("id", "u4"), ("unix_ts", "u8"), ("nhit", "u4")])
+HITS_DTYPE = np.dtype(
+    [("id", "u4"), ("x", "f8"), ("y", "f8"), ("z", "f8"), ("E", "f8"), ("t", "f8")]
+)
+PACKETS_DTYPE = np.dtype([("io_group", "u1"), ("chip_id", "u1"), ("dataword", "u2")])
+SEGMENTS_DTYPE = np.dtype(
+    [
+        (f"{axis}_{end}", "f4")
+        for end in ["start", "end"]
+        for axis in "xyz"
+    ]
+    + [("dE", "f4"), ("pdg_id", "i4")]
+)
+LIGHT_EVENTS_DTYPE = np.dtype([("id", "u4"), ("utime_ms", "u8", (8,))])
+LIGHT_WVFM_DTYPE = np.dtype([("samples", "i2", (8, 64, 1000))])
+DET_BOUNDS_DTYPE = np.dtype([("bounds", "f8", (2, 3))])
+
+# center of the detector in the hit coordinates, minirun4 is in cm and minirun3 in mm
+DETECTOR_CENTER = {"minirun4": (0, -268, 1300), "minirun3": (0, 420, 0)}
+TRUTH_DATASET = {"minirun4": "mc_truth/segments", "minirun3": "mc_truth/tracks"}
+T0 = 1_700_000_000  # s
+
+
+def make_flow_file(
+    filename,
+    n_events=10,
+    hits_per_event=1000,
+    segments_per_event=100,
+    light_per_event=2,
+    n_light_events=None,
+    layout="minirun4",
+    truth=True,
+    seed=0,
+):
+    """
+    Write a synthetic flow file with charge events, prompt and final hits, packets,
+    truth segments (in the minirun3 or minirun4 layout), light events and waveforms
+    and the detector bounds.
+
+    Each charge event has light_per_event light events close in time. The other light
+    events (up to n_light_events in total) match no charge event, and all light events
+    are shuffled so they are not time ordered. Only the waveforms of the matched light
+    events are written, the others are left to the fill value to keep the file small.
+    """
+    rng = np.random.default_rng(seed)
+    n_hits = n_events * hits_per_event
+    n_light_events = max(n_light_events or 0, n_events * light_per_event)
+
+    with h5py.File(filename, "w") as f:
+        # charge events and hits
+        events = np.zeros(n_events, dtype=EVENTS_DTYPE)
+        events["id"] = np.arange(n_events)
+        events["unix_ts"] = T0 + 2 * np.arange(n_events)
+        events["nhit"] = hits_per_event
+        f.create_dataset("charge/events/data", data=events)
+
+        event_of_hit = np.repeat(np.arange(n_events), hits_per_event)
+        for name in ["charge/calib_prompt_hits", "charge/calib_final_hits"]:
+            f.create_dataset(f"{name}/data", data=make_hits(rng, n_hits, layout))
+            write_ref(
+                f, "charge/events", name, event_of_hit, np.arange(n_hits), n_events, n_hits
+            )
+
+        # every prompt hit comes from one packet
+        f.create_dataset("charge/packets/data", data=np.zeros(n_hits, dtype=PACKETS_DTYPE))
+        hit_index = np.arange(n_hits)
+        write_ref(
+            f, "charge/calib_prompt_hits", "charge/packets", hit_index, hit_index, n_hits, n_hits
+        )
+
+        # every packet comes from one of the segments of its event
+        if truth:
+            n_segments = n_events * segments_per_event
+            truth_name = TRUTH_DATASET[layout]
+            segments = make_segments(rng, n_segments, layout)
+            f.create_dataset(f"{truth_name}/data", data=segments)
+            segment_of_packet = event_of_hit * segments_per_event + rng.integers(
+                0, segments_per_event, n_hits
+            )
+            write_ref(
+                f, "charge/packets", truth_name, hit_index, segment_of_packet, n_hits, n_segments
+            )
+
+        # light events, the first ones are within 0.2 s from a charge event,
+        # the others in between the charge events (which are 2 s apart)
+        n_matched = n_events * light_per_event
+        n_unmatched = n_light_events - n_matched
+        utime_ms = np.concatenate(
+            [
+                np.repeat(events["unix_ts"] * 1000, light_per_event)
+                + rng.integers(-200, 200, n_matched),
+                (T0 + 2 * rng.integers(0, n_events, n_unmatched) + 1) * 1000
+                + rng.integers(-400, 400, n_unmatched),
+            ]
+        )
+        order = rng.permutation(n_light_events)
+        light = np.zeros(n_light_events, dtype=LIGHT_EVENTS_DTYPE)
+        light["id"] = np.arange(n_light_events)
+        light["utime_ms"] = utime_ms[order, None]
+        f.create_dataset("light/events/data", data=light)
+
+        wvfm = f.create_dataset(
+            "light/wvfm/data", shape=(n_light_events,), dtype=LIGHT_WVFM_DTYPE, chunks=(1,)
+        )
+        waveform = np.zeros(1, dtype=LIGHT_WVFM_DTYPE)
+        for row in np.flatnonzero(order < n_matched):
+            samples = rng.normal(0, 5, (8, 64, 1000))
+            samples[:, :, 300:350] += rng.uniform(0, 2000, (8, 64, 1))
+            waveform["samples"][0] = samples
+            wvfm[row : row + 1] = waveform
+        light_index = np.arange(n_light_events)
+        write_ref(
+            f,
+            "light/events",
+            "light/wvfm",
+            light_index,
+            light_index,
+            n_light_events,
+            n_light_events,
+        )
+
+        f.create_dataset("geometry_info/det_bounds/data", data=make_det_bounds())
+
+
+def make_hits(rng, n_hits, layout):
+    hits = np.zeros(n_hits, dtype=HITS_DTYPE)
+    hits["id"] = np.arange(n_hits)
+    scale = 10 if layout == "minirun3" else 1
+    for axis, center in zip("xyz", DETECTOR_CENTER[layout]):
+        hits[axis] = center + rng.uniform(-60, 60, n_hits) * scale
+    hits["E"] = rng.exponential(0.1e-3, n_hits)  # GeV
+    hits["t"] = rng.uniform(0, 2000, n_hits)
+    return hits
+
+
+def make_segments(rng, n_segments, layout):
+    segments = np.zeros(n_segments, dtype=SEGMENTS_DTYPE)
+    # the truth is in cm for both layouts
+    scale = 0.1 if layout == "minirun3" else 1
+    for axis, center in zip("xyz", DETECTOR_CENTER[layout]):
+        start = center * scale + rng.uniform(-60, 60, n_segments)
+        segments[f"{axis}_start"] = start
+        segments[f"{axis}_end"] = start + rng.normal(0, 0.5, n_segments)
+    segments["dE"] = rng.exponential(1, n_segments)
+    segments["pdg_id"] = 13
+    return segments
+
+
+def make_det_bounds():
+    """Bounds of the 8 tpcs of the 2x2, in mm"""
+    bounds = np.zeros(8, dtype=DET_BOUNDS_DTYPE)
+    for tpc in range(8):
+        module, side = divmod(tpc, 2)
+        x0 = (-639.31 if module % 2 == 0 else 30.69) + side * 305
+        z0 = -643.163 if module < 2 else 26.837
+        bounds["bounds"][tpc] = [[x0, -216.7, z0], [x0 + 305, 1017.7, z0 + 616.326]]
+    return bounds
+
+
+def write_ref(f, parent, child, parent_index, child_index, n_parent, n_child):
+    """Write the h5flow references between two datasets, one row per (parent, child) pair"""
+    ref = np.stack([parent_index, child_index], axis=1).astype(REF_DTYPE)
+    ref_dset = f.create_dataset(f"{parent}/ref/{child}/ref", data=ref, maxshape=(None, 2))
+    ref_dset.attrs["dset0"] = f[f"{parent}/data"].ref
+    ref_dset.attrs["dset1"] = f[f"{child}/data"].ref
+    f[f"{child}/ref/{parent}/ref"] = ref_dset  # the same dataset, seen from the child
+    f.create_dataset(
+        f"{parent}/ref/{child}/ref_region", data=ref_region(parent_index, n_parent)
+    )
+    f.create_dataset(
+        f"{child}/ref/{parent}/ref_region", data=ref_region(child_index, n_child)
+    )
+
+
+def ref_region(index, n):
+    """For every row, the range of reference rows that point to it"""
+    region = np.zeros(n, dtype=REF_REGION_DTYPE)
+    rows = np.arange(len(index))
+    start = np.full(n, len(index))
+    stop = np.zeros(n, dtype=np.int64)
+    np.minimum.at(start, index, rows)
+    np.maximum.at(stop, index, rows + 1)
+    referenced = stop > 0
+    region["start"][referenced] = start[referenced]
+    region["stop"][referenced] = stop[referenced]
+    return region
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("filename")
+    parser.add_argument("--events", type=int, default=10)
+    parser.add_argument("--hits", type=int, default=1000, help="hits per event")
+    parser.add_argument("--segments", type=int, default=100, help="truth segments per event")
+    parser.add_argument("--light-per-event", type=int, default=2)
+    parser.add_argument("--light-events", type=int, default=None, help="total light events")
+    parser.add_argument("--layout", choices=list(TRUTH_DATASET), default="minirun4")
+    parser.add_argument("--no-truth", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    make_flow_file(
+        args.filename,
+        n_events=args.events,
+        hits_per_event=args.hits,
+        segments_per_event=args.segments,
+        light_per_event=args.light_per_event,
+        n_light_events=args.light_events,
+        layout=args.layout,
+        truth=not args.no_truth,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Utility functions for caching derived data in the app
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+# returned by LRUCache.get when a key is not cached, None can be a cached value
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache, bounded both in the number of items
+    and in the (estimated) memory used by the values. Counts hits and misses.
+    """
+
+    def __init__(self, max_items=128, max_bytes=None, name="cache"):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # key -> (value, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            item = self._items.get(key, MISSING)
+            if item is MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, nbytes=None):
+        if nbytes is None:
+            nbytes = estimate_nbytes(value)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return  # would evict everything else
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+            self._items[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while len(self._items) > self.max_items or (
+                self.max_bytes is not None and self._nbytes > self.max_bytes
+            ):
+                _, (_, evicted_nbytes) = self._items.popitem(last=False)
+                self._nbytes -= evicted_nbytes
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """Hit and miss counts and size of the cache"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "items": len(self._items),
+            "bytes": self._nbytes,
+        }
+
+    def __repr__(self):
+        stats = self.stats()
+        return (
+            f"{self.name}: {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['items']} items, {stats['bytes'] / 1024**2:.1f} MB"
+        )
+
+
+class FigureCache:
+    """
+    Cache of finished figures, serialized to JSON, keyed by the content hash of
+    the file, the event ID and the display options. Recently used figures are kept
+    in memory and all figures are stored on disk, up to the given sizes. The figures
+    on disk are kept over restarts, so the version has to change when the figures
+    are built differently.
+    """
+
+    def __init__(
+        self, folder, max_memory_bytes=256 * 1024**2, max_disk_bytes=2 * 1024**3, version=1
+    ):
+        self.folder = Path(folder)
+        self.max_disk_bytes = max_disk_bytes
+        self.version = version
+        self.memory = LRUCache(
+            max_items=1024, max_bytes=max_memory_bytes, name="figure cache"
+        )
+        # size of the figures on disk, as found by the last eviction plus what was
+        # stored since (by this process), None until the folder is first looked at
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+
+    def get(self, file_hash, evid, options=None):
+        """Get the figure JSON, or None if it is not cached"""
+        key = self._key(file_hash, evid, options)
+        figure_json = self.memory.get(key)
+        if figure_json is not MISSING:
+            return figure_json
+        path = self.folder / f"{key}.json"
+        try:
+            figure_json = path.read_text()
+            os.utime(path)  # mark as recently used for the eviction
+        except OSError:
+            return None
+        self.memory.put(key, figure_json, len(figure_json))
+        return figure_json
+
+    def put(self, file_hash, evid, figure_json, options=None):
+        key = self._key(file_hash, evid, options)
+        self.memory.put(key, figure_json, len(figure_json))
+        path = self.folder / f"{key}.json"
+        try:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            tmp_path.write_text(figure_json)
+            os.replace(tmp_path, path)
+            self._evict(len(figure_json))
+        except OSError as err:
+            print(f"Can't store figure in {self.folder} : {err}")
+
+    def _evict(self, nbytes):
+        # remove the least recently used figures from disk, the folder is only looked
+        # at when the figures stored since the last time may have filled it up
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += nbytes
+                if self._disk_bytes <= self.max_disk_bytes:
+                    return
+            self._disk_bytes = evict_lru_files(
+                self.folder.glob("*.json"), self.max_disk_bytes
+            )
+
+    def _key(self, file_hash, evid, options):
+        options = json.dumps(options or {}, sort_keys=True)
+        options_hash = hashlib.blake2b(options.encode(), digest_size=8).hexdigest()
+        return f"{file_hash}_v{self.version}_{evid}_{options_hash}"
+
+
+class Prefetcher:
+    """
+    Load the events around the displayed one in the background, so stepping
+    through a run does not have to wait for the data to be read.
+
+    load(filename, evid, *args) is called on a thread pool for the events evid +- 1..depth
+    of the run, which may be in the neighbouring files, and is expected to store what it
+    loads in a cache. The jobs are kept per client, e.g. per user of a shared data
+    service, so the users do not cancel each other's jobs.
+    """
+
+    def __init__(self, load, depth=2, max_workers=2, max_clients=64):
+        self.load = load
+        self.depth = depth
+        self.max_clients = max_clients
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="prefetch"
+        )
+        # client -> (files of the run, {event ID in the run: future}), least recent first
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def schedule(self, run, evid, *args, client=None):
+        """
+        Prefetch the neighbours of an event, by its event ID in the run (see RunIndex),
+        dropping the jobs of the client that are no longer needed. The extra arguments
+        are passed on to load.
+        """
+        num_events = len(run)
+        if num_events <= 0 or self.depth <= 0:
+            return
+        # the closest events first, the next event before the previous one
+        wanted = []
+        for distance in range(1, self.depth + 1):
+            for neighbour in (evid + distance, evid - distance):
+                neighbour %= num_events  # the app wraps around as well
+                if neighbour != evid and neighbour not in wanted:
+                    wanted.append(neighbour)
+
+        with self._lock:
+            filenames, pending = self._clients.pop(client, (None, {}))
+            if run.filenames != filenames:
+                self._cancel(pending)
+            # keep the jobs of the neighbours that are still wanted, also when they are
+            # done, so the events that were loaded already are not loaded again
+            for neighbour, future in list(pending.items()):
+                if neighbour not in wanted:
+                    future.cancel()
+                    del pending[neighbour]
+            for neighbour in wanted:
+                if neighbour not in pending:
+                    pending[neighbour] = self._executor.submit(
+                        self._run, *run.locate(neighbour), *args
+                    )
+            self._clients[client] = (list(run.filenames), pending)
+            while len(self._clients) > self.max_clients:
+                _, (_, pending) = self._clients.popitem(last=False)
+                self._cancel(pending)
+
+    def cancel(self):
+        """Cancel all the jobs that did not start yet"""
+        with self._lock:
+            for _, pending in self._clients.values():
+                self._cancel(pending)
+            self._clients.clear()
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    @staticmethod
+    def _cancel(pending):
+        for future in pending.values():
+            future.cancel()
+        pending.clear()
+
+    def _run(self, filename, evid, *args):
+        try:
+            self.load(filename, evid, *args)
+        except Exception as err:
+            print(f"Could not prefetch event {evid} of {filename} : {err}")
+
+
+def caches_to_prometheus(stats):
+    """
+    The cache statistics of several processes, as {process: {cache name: LRUCache.stats()}},
+    in the Prometheus text format
+    """
+    lines = []
+    for metric, kind, field in [
+        ("evd_cache_hits_total", "counter", "hits"),
+        ("evd_cache_misses_total", "counter", "misses"),
+        ("evd_cache_items", "gauge", "items"),
+        ("evd_cache_bytes", "gauge", "bytes"),
+    ]:
+        lines.append(f"# TYPE {metric} {kind}")
+        for process, caches in stats.items():
+            for name, cache in sorted(caches.items()):
+                lines.append(f'{metric}{{process="{process}",cache="{name}"}} {cache[field]}')
+    return "\n".join(lines) + "\n"
+
+
+def evict_lru_files(paths, max_bytes):
+    """
+    Remove the least recently used (by modification time) of the files until
+    they take at most max_bytes. Files that are used should be touched.
+    Returns the size of the files that are left.
+    """
+    files = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except OSError:
+            continue  # removed in the meantime
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+    return total
+
+
+def estimate_nbytes(value):
+    """Estimate the memory used by (nested containers of) numpy arrays"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_nbytes(v) for v in value)
+    return sys.getsizeof(value)
@@ -0,0 +1,280 @@
+"""
+Data service for serving the app with several worker processes. The service owns
+the open flow files and the caches, and the workers get their figures from it over
+a Unix socket, so users browsing the same run share the I/O. Run with:
+``python data_service.py /tmp/evd.sock``
+and start the app with ``EVD_DATA_SERVICE=/tmp/evd.sock``.
+"""
+import argparse
+import os
+import shutil
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+import plotly.io as pio
+
+from cache_utils import Prefetcher
+from display_utils import (
+    cache_stats,
+    get_3d_figure_json,
+    get_layer_json,
+    parse_contents,
+    plot_waveforms,
+    prefetch_event,
+)
+from file_utils import FILE_POOL, RunIndex, get_file_schema, open_flow_file
+from overview_utils import get_overview_json
+from summary_utils import find_next_event, get_event_summary, select_events
+from timing_utils import SPAN_STATS, add_spans, collect_spans, span
+
+# the connections to the service are authenticated with this key when it is set
+AUTHKEY = os.environ.get("EVD_DATA_SERVICE_KEY", "").encode() or None
+
+
+class DataServiceError(Exception):
+    """An error raised in the data service while handling a request"""
+
+
+def process_metrics():
+    """The span histograms and the cache statistics of this process"""
+    return {"spans": SPAN_STATS.snapshot(), "caches": cache_stats()}
+
+
+class LocalDataSource:
+    """Get the data for the app from the files and caches of this process"""
+
+    def __init__(self, prefetch_depth=2, prefetch_workers=2):
+        self.prefetcher = Prefetcher(
+            prefetch_event, depth=prefetch_depth, max_workers=prefetch_workers
+        )
+
+    def num_events(self, filename):
+        _, num_events = parse_contents(filename)
+        return num_events
+
+    def schema(self, filename):
+        return get_file_schema(filename)._asdict()
+
+    def figure_json(self, filename, evid, options=None):
+        return get_3d_figure_json(filename, evid, options)
+
+    def layer_json(self, filename, evid, layer, options=None):
+        return get_layer_json(filename, evid, layer, options)
+
+    def waveform_json(self, filename, evid, opids, stack=False, pixels=None):
+        """
+        The waveforms figure as JSON, decimated to the width of the plot in pixels,
+        or None if there is no light for the event
+        """
+        with open_flow_file(filename) as data:
+            fig = plot_waveforms(data, evid, opids, stack, pixels)
+        if isinstance(fig, list):
+            return None
+        return pio.to_json(fig, validate=False)
+
+    def prefetch(self, run, evid, layers=(), client=None):
+        """
+        Load the neighbours of an event in the background, by its event ID in the
+        run, given as RunIndex.to_dict. client identifies the user, whose previous
+        jobs are replaced.
+        """
+        self.prefetcher.schedule(RunIndex(**run), evid, tuple(layers), client=client)
+
+    def next_event(self, filename, evid, step, filters, wrap=True):
+        """
+        The next (step 1) or previous (step -1) event that passes the filters, the
+        keyword arguments of select_events. Returns None if no event passes, or
+        none is left in the file when not wrapping around it.
+        """
+        selected = select_events(get_event_summary(filename), **filters)
+        return find_next_event(selected, evid, step, wrap)
+
+    def count_events(self, filename, filters):
+        """The number of events that pass the filters"""
+        return int(np.count_nonzero(select_events(get_event_summary(filename), **filters)))
+
+    def overview_json(self, filename):
+        """The figures of the run overview as JSON, see get_overview_json"""
+        return get_overview_json(filename)
+
+    def metrics(self):
+        return process_metrics()
+
+    def close(self):
+        self.prefetcher.shutdown()
+        FILE_POOL.close_all()
+
+
+class DataServiceClient:
+    """
+    Get the data for the app from the data service, with the same methods as
+    LocalDataSource. Every thread has its own connection to the service.
+    """
+
+    def __init__(self, address, authkey=AUTHKEY):
+        self.address = address
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def num_events(self, filename):
+        return self._request("num_events", os.path.abspath(filename))
+
+    def schema(self, filename):
+        return self._request("schema", os.path.abspath(filename))
+
+    def figure_json(self, filename, evid, options=None):
+        return self._request("figure_json", os.path.abspath(filename), evid, options)
+
+    def layer_json(self, filename, evid, layer, options=None):
+        return self._request("layer_json", os.path.abspath(filename), evid, layer, options)
+
+    def waveform_json(self, filename, evid, opids, stack=False, pixels=None):
+        return self._request(
+            "waveform_json", os.path.abspath(filename), evid, opids, stack, pixels
+        )
+
+    def prefetch(self, run, evid, layers=(), client=None):
+        run = dict(run, filenames=[os.path.abspath(filename) for filename in run["filenames"]])
+        return self._request("prefetch", run, evid, layers, client)
+
+    def next_event(self, filename, evid, step, filters, wrap=True):
+        return self._request(
+            "next_event", os.path.abspath(filename), evid, step, filters, wrap
+        )
+
+    def count_events(self, filename, filters):
+        return self._request("count_events", os.path.abspath(filename), filters)
+
+    def overview_json(self, filename):
+        return self._request("overview_json", os.path.abspath(filename))
+
+    def metrics(self):
+        return self._request("metrics")
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _request(self, method, *args):
+        with span("data service"):
+            # reconnect once, e.g. when the service was restarted
+            for attempt in range(2):
+                connection = getattr(self._local, "connection", None)
+                try:
+                    if connection is None:
+                        connection = Client(
+                            self.address, family="AF_UNIX", authkey=self.authkey
+                        )
+                        self._local.connection = connection
+                    start = time.perf_counter()
+                    connection.send((method, args))
+                    status, result, spans = connection.recv()
+                    break
+                except (EOFError, OSError):
+                    self.close()
+                    if attempt == 1:
+                        raise
+            # show the work done in the service in the timings of the callback
+            add_spans(spans, start)
+        if status == "error":
+            raise DataServiceError(result)
+        return result
+
+
+class DataService:
+    """Handle the requests of the app workers, one thread per connection"""
+
+    METHODS = [
+        "num_events",
+        "schema",
+        "figure_json",
+        "layer_json",
+        "waveform_json",
+        "prefetch",
+        "next_event",
+        "count_events",
+        "overview_json",
+        "metrics",
+    ]
+
+    def __init__(self, address, source, authkey=AUTHKEY):
+        self.address = address
+        self.source = source
+        self.authkey = authkey
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.unlink(self.address)  # left over from a previous run
+        with Listener(self.address, family="AF_UNIX", authkey=self.authkey) as listener:
+            print(f"Data service listening on {self.address}")
+            while True:
+                try:
+                    connection = listener.accept()
+                except OSError as err:
+                    print(f"Connection to the data service failed : {err}")
+                    continue
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    method, args = connection.recv()
+                except (EOFError, OSError):
+                    return  # the worker closed the connection
+                with collect_spans() as spans:
+                    try:
+                        if method not in self.METHODS:
+                            raise ValueError(f"Unknown method {method}")
+                        response = ["ok", getattr(self.source, method)(*args)]
+                    except Exception as err:
+                        print(f"Data service could not handle {method}{args} : {err}")
+                        response = ["error", f"{type(err).__name__}: {err}"]
+                # the spans are only complete when the context is left
+                response = (*response, spans)
+                try:
+                    connection.send(response)
+                except (EOFError, OSError):
+                    return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("address", help="path of the Unix socket to listen on")
+    parser.add_argument("--prefetch-depth", type=int, default=2)
+    parser.add_argument("--prefetch-workers", type=int, default=2)
+    parser.add_argument(
+        "--max-open-files", type=int, default=None, help="number of flow files kept open"
+    )
+    parser.add_argument(
+        "--upload-folder",
+        default="cache",
+        help="folder the app uploads the files to, removed when the service stops",
+    )
+    args = parser.parse_args(argv)
+    if args.max_open_files is not None:
+        FILE_POOL.set_max_open(args.max_open_files)
+    source = LocalDataSource(args.prefetch_depth, args.prefetch_workers)
+    try:
+        DataService(args.address, source).serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.close()
+        if os.path.exists(args.address):
+            os.unlink(args.address)
+        # the workers leave the uploads they share to the service
+        try:
+            shutil.rmtree(args.upload_folder)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            print("Can't clean %s : %s" % (args.upload_folder, err.strerror))
+
+
+if __name__ == "__main__":
+    main()
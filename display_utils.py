@@ -1,95 +1,447 @@
 """
 Utility functions for displaying data in the app
 """
-# TODO: remove dependency on h5flow
-import h5flow
+import base64
+import functools
+import os
+from collections import namedtuple
+from pathlib import Path
+
 import numpy as np
 import plotly
 import plotly.graph_objects as go
+import plotly.io as pio
+
+from cache_utils import MISSING, FigureCache, LRUCache
+from file_utils import (
+    SIDECAR_FOLDER,
+    evict_sidecars,
+    file_content_hash,
+    get_file_schema,
+    load_sidecar,
+    load_sidecar_array,
+    open_flow_file,
+    save_sidecar,
+    sidecar_path,
+)
+from timing_utils import span
+from waveform_utils import (
+    WaveformFeatures,
+    compute_waveform_features,
+    decimate_minmax,
+)
+
+COLORSCALE = plotly.colors.make_colorscale(
+    plotly.colors.convert_colors_to_same_type(plotly.colors.sequential.YlOrRd)[0]
+)
+# corners of the optical detectors, per detector geometry
+LIGHT_TRAP_GEOMETRY = {}
+
+# dense events are shown with their hits merged into voxels, unless zoomed in
+HIT_BUDGET = 20000  # maximum number of points per hit trace
+VOXEL_SIZE = 0.5  # smallest voxel size in cm, doubled until the budget is met
+# the camera eye is closer than this to the center when zoomed in, the default is at ~2.2
+ZOOM_FULL_RESOLUTION = 1.0
+
+# the figure starts with the traces that change per event: the prompt hits, final hits,
+# segments and light traps, followed by the static detector geometry
+LIGHT_TRAPS_TRACE = 3
+# the layers that are only loaded when they are switched on, and the index of their trace
+OPTIONAL_LAYERS = {"final hits": 1, "segments": 2, "light": LIGHT_TRAPS_TRACE}
+# datasets of the hits layers
+HIT_DATASETS = {
+    "prompt hits": "charge/calib_prompt_hits",
+    "final hits": "charge/calib_final_hits",
+}
+
+# send the hit coordinates and energies as binary typed arrays, needs plotly.js >= 2.28
+TYPED_ARRAYS = True
+
+# light events within this time (in s) from a charge event are matched to it
+LIGHT_MATCH_TOLERANCE = 0.5
+
+# waveforms and integrals of the light matched to recently displayed events
+LIGHT_CACHE_ITEMS = 32
+LIGHT_CACHE_BYTES = 512 * 1024**2
+
+# the SiPM channels that are read out for each tpc, module 0 differs from the others
+SIPM_CHANNELS_MODULE0 = np.array(
+    [2, 3, 4, 5, 6, 7]
+    + [9, 10]
+    + [11, 12]
+    + [13, 14]
+    + [18, 19, 20, 21, 22, 23]
+    + [25, 26]
+    + [27, 28]
+    + [29, 30]
+    + [34, 35, 36, 37, 38, 39]
+    + [41, 42]
+    + [43, 44]
+    + [45, 46]
+    + [50, 51, 52, 53, 54, 55]
+    + [57, 58]
+    + [59, 60]
+    + [61, 62]
+)
+SIPM_CHANNELS_MODULES = np.array(
+    [4, 5, 6, 7, 8, 9]
+    + [10, 11, 12, 13, 14, 15]
+    + [20, 21, 22, 23, 24, 25]
+    + [26, 27, 28, 29, 30, 31]
+    + [36, 37, 38, 39, 40, 41]
+    + [42, 43, 44, 45, 46, 47]
+    + [52, 53, 54, 55, 56, 57]
+    + [58, 59, 60, 61, 62, 63]
+)
+# (tpc, channel) of every optical detector: 2 tpcs per module, 48 channels per tpc,
+# so 96 channels per module and 384 in total, ordered by opid
+SIPM_TPCS = np.repeat(np.arange(8), 48)
+SIPM_CHANNELS = np.concatenate(
+    [SIPM_CHANNELS_MODULE0] * 2 + [SIPM_CHANNELS_MODULES] * 6
+)
+# number of light events read from the file at a time
+WAVEFORM_READ_CHUNK = 8
+# the waveforms are decimated to about this many points when the width of the plot
+# (in pixels) is not known
+WAVEFORM_PIXELS = 600
+# number of light events analysed at a time when computing the features of a file
+LIGHT_FEATURES_CHUNK = 64
+# number of light events per task when the features are computed on several processes
+LIGHT_FEATURES_TASK = 1024
+# bump when the waveform features change, so old sidecar files are not used
+LIGHT_FEATURES_VERSION = 2
+# type of every feature in its sidecar file
+LIGHT_FEATURE_DTYPES = {
+    "baseline": np.float32,
+    "integral": np.float32,
+    "peak_amplitude": np.float32,
+    "peak_time": np.int16,
+    "saturated": bool,
+}
+
+LightIndex = namedtuple("LightIndex", ["times", "order", "ids"])
+# waveforms is None when the features come from the sidecar file of the features
+LightData = namedtuple("LightData", ["match_light", "waveforms", "features", "integral"])
+
+# hits and segments of recently displayed (or prefetched) events
+EVENT_CACHE_ITEMS = 64
+EVENT_CACHE_BYTES = 512 * 1024**2
+
+# the truth segments are looked up for windows of this many events at a time
+SEGMENT_WINDOW = 64
+# only the fields of the segments that are drawn are read
+SEGMENT_FIELDS = ["x_start", "y_start", "z_start", "x_end", "y_end", "z_end"]
+SEGMENT_CACHE_ITEMS = 16
+SEGMENT_CACHE_BYTES = 256 * 1024**2
+
+# segments of a window of events, the segments of event start + i are
+# segments[offsets[i]:offsets[i + 1]]
+SegmentWindow = namedtuple("SegmentWindow", ["start", "offsets", "segments"])
+
+# finished figures, in memory and on disk
+FIGURE_CACHE_MEMORY_BYTES = 256 * 1024**2
+FIGURE_CACHE_DISK_BYTES = 2 * 1024**3
+# bump when the figures are built differently (e.g. the trace order or colouring), so
+# the figures stored on disk by an older version are not used
+FIGURE_VERSION = 1
+
+LIGHT_CACHE = LRUCache(LIGHT_CACHE_ITEMS, LIGHT_CACHE_BYTES, name="light cache")
+EVENT_CACHE = LRUCache(EVENT_CACHE_ITEMS, EVENT_CACHE_BYTES, name="event cache")
+SEGMENT_CACHE = LRUCache(SEGMENT_CACHE_ITEMS, SEGMENT_CACHE_BYTES, name="segment cache")
+FIGURE_CACHE = FigureCache(
+    Path(SIDECAR_FOLDER) / "figures",
+    FIGURE_CACHE_MEMORY_BYTES,
+    FIGURE_CACHE_DISK_BYTES,
+    # the light traps are coloured with the waveform features
+    version=f"{FIGURE_VERSION}.{LIGHT_FEATURES_VERSION}",
+)
+
+
+def cache_stats():
+    """The hit and miss counts and the sizes of the caches, by cache name"""
+    caches = (LIGHT_CACHE, EVENT_CACHE, SEGMENT_CACHE, FIGURE_CACHE.memory)
+    return {cache.name: cache.stats() for cache in caches}
 
 
 def parse_contents(filename):
-    data = h5flow.data.H5FlowDataManager(filename, "r")
-    num_events = data["charge/events/data"].shape[0]
+    """
+    Get the (pooled) handle for the file and the number of events in it.
+    Use open_flow_file to keep the handle open while working with it.
+    """
+    with open_flow_file(filename) as data:
+        num_events = data["charge/events/data"].shape[0]
     return data, num_events
 
 
-def create_3d_figure(data, evid):
-    fig = go.Figure()
-    print("here we go")
+def get_event_data(data, evid, layer="prompt hits"):
+    """
+    Get the data of one layer of an event: the "prompt hits", "final hits" or truth
+    "segments". Every layer is kept in a cache by itself, so events that were shown or
+    prefetched before do not have to be read again, and layers that are not shown are
+    not read at all.
+    """
+    key = (data.filepath, evid, layer)
+    event_data = EVENT_CACHE.get(key)
+    if event_data is MISSING:
+        event_data = load_event_data(data, evid, layer)
+        EVENT_CACHE.put(key, event_data)
+    return event_data
+
+
+def load_event_data(data, evid, layer):
+    if layer == "segments":
+        # select the segments (truth) for the current event, None for data
+        if not get_file_schema(data.filepath).has_truth:
+            return None
+        with span("segment lookup"):
+            return get_event_segments(data, evid)
+
     # Select the hits for the current event
-    prompthits_ev = data["charge/events", "charge/calib_prompt_hits", evid]
-    finalhits_ev = data["charge/events", "charge/calib_final_hits", evid]
-    # select the segments (truth) for the current event
-    try:
-        prompthits_segs = data[
-            "charge/events",
-            "charge/calib_prompt_hits",
-            "charge/packets",
-            "mc_truth/segments",  # called segments in minirun4
-            evid,
-        ]
-        sim_version = "minirun4"
-        print("Found truth info in minirun4 format")
-    except:
-        print("No truth info in minirun4 format found")
-        try:
-            prompthits_segs = data[
-                "charge/events",
-                "charge/calib_prompt_hits",
-                "charge/packets",
-                "mc_truth/tracks",  # called tracks in minirun3
-                evid,
-            ]
-            sim_version = "minirun3"
-            print("Found truth info in minirun3 format")
-        except:
-            print("No truth info in minirun3 format found")
-            prompthits_segs = None
+    with span("hit reads"):
+        hits_ev = data["charge/events", HIT_DATASETS[layer], evid]
+    return hits_ev.data.flatten()
+
+
+def get_event_segments(data, evid):
+    """
+    Get the truth segments of an event: for each prompt hit the first segment of its
+    first packet, without duplicates. The segments are looked up for the whole window
+    of events around evid at once, and kept in a cache.
+    """
+    start = evid - evid % SEGMENT_WINDOW
+    key = (data.filepath, start)
+    window = SEGMENT_CACHE.get(key)
+    if window is MISSING:
+        num_events = data["charge/events/data"].shape[0]
+        window = load_segment_window(data, start, min(start + SEGMENT_WINDOW, num_events))
+        SEGMENT_CACHE.put(key, window)
+    i = evid - window.start
+    return window.segments[window.offsets[i] : window.offsets[i + 1]]
+
+
+def load_segment_window(data, start, stop):
+    """
+    Resolve the events -> prompt hits -> packets -> segments references for the
+    events in [start, stop) in one pass over the reference datasets, and read
+    their segments.
+    """
+    truth_dataset = get_file_schema(data.filepath).truth_dataset
+    event, hit = get_children(data, "charge/events", "charge/calib_prompt_hits", start, stop)
+    packet = get_first_child(data, "charge/calib_prompt_hits", "charge/packets", hit)
+    segment = get_first_child(data, "charge/packets", truth_dataset, packet)
+    has_segment = segment >= 0
+    event, segment = event[has_segment], segment[has_segment]
+
+    # every segment only once per event, grouped by event
+    pairs = np.unique(np.stack([event, segment], axis=1), axis=0)
+    event, segment = pairs[:, 0], pairs[:, 1]
+    offsets = np.searchsorted(event, np.arange(start, stop + 1))
+
+    rows, inverse = np.unique(segment, return_inverse=True)
+    segments = read_rows(data[f"{truth_dataset}/data"].fields(SEGMENT_FIELDS), rows)
+    return SegmentWindow(start, offsets, segments[inverse])
+
+
+def get_children(data, parent, child, start, stop):
+    """
+    Get all the (parent, child) index pairs of the parent rows in [start, stop),
+    ordered by parent and in reference order within a parent.
+    """
+    region = data.get_ref_region(parent, child)[start:stop]
+    region = region[region["stop"] > region["start"]]
+    if len(region) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    ref, ref_dir = data.get_ref(parent, child)
+    ref = ref[region["start"].min() : region["stop"].max()].astype(np.int64)
+    parents, children = ref[:, ref_dir[0]], ref[:, ref_dir[1]]
+    selected = (parents >= start) & (parents < stop)
+    order = np.argsort(parents[selected], kind="stable")
+    return parents[selected][order], children[selected][order]
+
+
+def get_first_child(data, parent, child, parents):
+    """
+    Get the first referenced child row of every parent row, or -1 for
+    the parents that reference none.
+    """
+    first = np.full(len(parents), -1, dtype=np.int64)
+    if len(parents) == 0:
+        return first
+    lo, hi = parents.min(), parents.max() + 1
+    region = data.get_ref_region(parent, child)[lo:hi][parents - lo]
+    referenced = region["stop"] > region["start"]
+    if not referenced.any():
+        return first
+    ref, ref_dir = data.get_ref(parent, child)
+    ref = ref[
+        region["start"][referenced].min() : region["stop"][referenced].max()
+    ].astype(np.int64)
+    # the first reference row of every parent, the rows are in reference order
+    ref_parents, first_row = np.unique(ref[:, ref_dir[0]], return_index=True)
+    children = ref[first_row, ref_dir[1]]
+    found = np.searchsorted(ref_parents, parents)
+    found = np.minimum(found, len(ref_parents) - 1)
+    matched = ref_parents[found] == parents
+    first[matched] = children[found[matched]]
+    return first
+
+
+def read_rows(dset, rows):
+    """Read sorted unique rows from a dataset, as one slice when they are close together"""
+    if len(rows) == 0:
+        return dset[0:0]
+    lo, hi = rows[0], rows[-1] + 1
+    if hi - lo <= 4 * len(rows):
+        return dset[lo:hi][rows - lo]
+    return dset[rows]
+
+
+def prefetch_event(filename, evid, layers=()):
+    """Load the data of an event and its optional layers into the caches, without plotting it"""
+    with open_flow_file(filename) as data:
+        get_event_data(data, evid)
+        for layer in layers:
+            if layer == "light":
+                get_light_data(data, evid)
+            else:
+                get_event_data(data, evid, layer)
+
+
+def get_3d_figure_json(filename, evid, options=None):
+    """
+    Get the 3D figure of an event as JSON. Figures are cached per file, event and
+    display options (the keyword arguments of create_3d_figure), so going back to
+    an event does not rebuild the figure.
+    """
+    options = options or {}
+    file_hash = file_content_hash(filename)
+    figure_json = FIGURE_CACHE.get(file_hash, evid, options)
+    if figure_json is None:
+        with open_flow_file(filename) as data, span("figure build"):
+            fig = create_3d_figure(data, evid, **options)
+        with span("figure serialization"):
+            figure_json = pio.to_json(fig, validate=False)
+        FIGURE_CACHE.put(file_hash, evid, figure_json, options)
+    return figure_json
+
+
+def get_layer_json(filename, evid, layer, options=None):
+    """
+    Get the trace of an optional layer of the 3D figure of an event as JSON, cached
+    like the figures. options are the keyword arguments of plot_layer.
+    """
+    options = options or {}
+    file_hash = file_content_hash(filename)
+    cache_options = dict(options, layer=layer)
+    trace_json = FIGURE_CACHE.get(file_hash, evid, cache_options)
+    if trace_json is None:
+        with open_flow_file(filename) as data, span(f"{layer} build"):
+            trace = plot_layer(data, evid, layer, **options)
+        with span("figure serialization"):
+            trace_json = pio.to_json(trace, validate=False)
+        FIGURE_CACHE.put(file_hash, evid, trace_json, cache_options)
+    return trace_json
+
+
+def create_3d_figure(data, evid, full_resolution=False, layers=()):
+    """
+    Create the 3D figure of an event with the prompt hits, the detector geometry and
+    the optional layers that are switched on. The other optional layers get an empty
+    trace, so the traces of every event are in the same place.
+    """
+    print("here we go")
+    schema = get_file_schema(data.filepath)
+    prompthits = get_event_data(data, evid)
 
     # Plot the prompt hits
     print("Plotting prompt hits")
-    prompthits_traces = go.Scatter3d(
-        x=prompthits_ev.data["x"].flatten(),
-        y=(prompthits_ev.data["y"].flatten()),
-        z=(prompthits_ev.data["z"].flatten()),
-        marker_color=prompthits_ev.data["E"].flatten()
-        * 1000,  # convert to MeV from GeV for minirun4, not sure for minirun3
-        marker={
-            "size": 1.75,
-            "opacity": 0.7,
-            "colorscale": "cividis",
-            "colorbar": {
-                "title": "Hit energy [MeV]",
-                "titlefont": {"size": 12},
-                "tickfont": {"size": 10},
-                "thickness": 15,
-                "len": 0.5,
-                "xanchor": "left",
-                "x": 0,
-            },
-        },
+    prompthits_trace = plot_hits(
+        prompthits,
+        schema.layout,
+        full_resolution,
         name="prompt hits",
-        mode="markers",
+        colorscale="cividis",
         showlegend=True,
-        opacity=0.7,
-        customdata=prompthits_ev.data["E"].flatten() * 1000,
-        hovertemplate="<b>x:%{x:.3f}</b><br>y:%{y:.3f}<br>z:%{z:.3f}<br>E:%{customdata:.3f}",
     )
     print("Adding prompt hits to figure")
-    fig.add_traces(prompthits_traces)
-
-    # Plot the final hits
-    print("Plotting final hits")
-    finalhits_traces = go.Scatter3d(
-        x=finalhits_ev.data["x"].flatten(),
-        y=(finalhits_ev.data["y"].flatten()),
-        z=(finalhits_ev.data["z"].flatten()),
-        marker_color=finalhits_ev.data["E"].flatten() * 1000,
+    # keep the camera and legend selection when the figure is updated
+    figure = go.Figure(layout=dict(uirevision="event display")).to_plotly_json()
+    figure["data"].append(prompthits_trace)
+
+    # the optional layers and static geometry are added as dicts, to skip validating them again
+    for layer in OPTIONAL_LAYERS:
+        if layer in layers:
+            figure["data"].append(plot_layer(data, evid, layer, full_resolution))
+        else:
+            figure["data"].append(layer_placeholder(layer))
+
+    # Draw the TPC
+    print("Drawing TPC")
+    with span("geometry"):
+        figure["data"].extend(get_tpc_traces(schema.layout))
+
+    return figure
+
+
+def plot_layer(data, evid, layer, full_resolution=False):
+    """Plot the trace of an optional layer of the 3D figure, as a dict"""
+    schema = get_file_schema(data.filepath)
+    if layer == "final hits":
+        print("Plotting final hits")
+        return plot_hits(
+            get_event_data(data, evid, layer),
+            schema.layout,
+            full_resolution,
+            name="final hits",
+            colorscale="Plasma",
+            showlegend=True,
+        )
+    if layer == "segments":
+        print("Plotting segments")
+        segments = get_event_data(data, evid, layer)
+        if segments is None:
+            return layer_placeholder(layer)
+        with span("segment traces"):
+            return plot_segs(
+                segments,
+                sim_version=schema.layout,
+                mode="lines",
+                name="edep segments",
+                line_color="red",
+                showlegend=True,
+            ).to_plotly_json()
+    if layer == "light":
+        with span("light traps"):
+            return draw_light_detectors(data, evid)[0]
+    raise ValueError(f"Unknown layer {layer}")
+
+
+def layer_placeholder(layer):
+    """The empty trace of an optional layer that is switched off"""
+    if layer == "final hits":
+        return dict(
+            type="scatter3d", x=[], y=[], z=[], mode="markers", name="final hits", showlegend=False
+        )
+    if layer == "segments":
+        return dict(
+            type="scatter3d", x=[], y=[], z=[], mode="lines", name="edep segments", showlegend=False
+        )
+    return dict(type="mesh3d", name="light traps", visible=False)
+
+
+def plot_hits(hits, layout, full_resolution=False, **kwargs):
+    """Plot hits coloured by their energy, as a dict"""
+    x, y, z, E = get_hit_points(hits, layout, full_resolution)
+    trace = go.Scatter3d(
+        x=x,
+        y=y,
+        z=z,
+        marker_color=E
+        * 1000,  # convert to MeV from GeV for minirun4, not sure for minirun3
         marker={
             "size": 1.75,
             "opacity": 0.7,
-            "colorscale": "Plasma",
+            "colorscale": kwargs.pop("colorscale"),
             "colorbar": {
                 "title": "Hit energy [MeV]",
                 "titlefont": {"size": 12},
@@ -100,44 +452,82 @@ def create_3d_figure(data, evid):
                 "x": 0,
             },
         },
-        name="final hits",
         mode="markers",
-        visible="legendonly",
-        showlegend=True,
         opacity=0.7,
-        customdata=finalhits_ev.data["E"].flatten() * 1000,
-        hovertemplate="<b>x:%{x:.3f}</b><br>y:%{y:.3f}<br>z:%{z:.3f}<br>E:%{customdata:.3f}",
+        hovertemplate="<b>x:%{x:.3f}</b><br>y:%{y:.3f}<br>z:%{z:.3f}<br>E:%{marker.color:.3f}",
+        **kwargs,
+    ).to_plotly_json()
+    if TYPED_ARRAYS:
+        encode_hit_arrays(trace)
+    return trace
+
+
+def get_hit_points(hits, sim_version, full_resolution=False):
+    """
+    Get the x, y, z and E of the hits to plot.
+    Unless full resolution is asked for, dense events are merged into voxels.
+    """
+    if full_resolution:
+        return hits["x"], hits["y"], hits["z"], hits["E"]
+    voxel_size = VOXEL_SIZE
+    if sim_version == "minirun3":  # hit coordinates are in mm
+        voxel_size = voxel_size * 10
+    return decimate_hits(hits, voxel_size, HIT_BUDGET)
+
+
+def decimate_hits(hits, voxel_size=VOXEL_SIZE, hit_budget=HIT_BUDGET):
+    """
+    Merge the hits in a voxel grid when there are more than hit_budget of them.
+    Each voxel is placed at the mean position of its hits and gets their summed energy.
+    The voxel size starts at voxel_size and is doubled until the budget is met.
+    Returns x, y, z and E arrays.
+    """
+    x, y, z, E = (np.asarray(hits[axis], dtype=float) for axis in "xyzE")
+    if len(E) <= hit_budget:
+        return x, y, z, E
+
+    coords = np.stack([x, y, z], axis=1)
+    origin = coords.min(axis=0)
+    while True:
+        cells = np.floor((coords - origin) / voxel_size).astype(np.int64)
+        keys = np.ravel_multi_index(cells.T, cells.max(axis=0) + 1)
+        _, voxel = np.unique(keys, return_inverse=True)
+        n_voxels = voxel.max() + 1
+        if n_voxels <= hit_budget:
+            break
+        voxel_size *= 2
+
+    print(f"Merged {len(E)} hits into {n_voxels} voxels of {voxel_size}")
+    counts = np.bincount(voxel, minlength=n_voxels)
+    x, y, z = (
+        np.bincount(voxel, weights=coords[:, i], minlength=n_voxels) / counts
+        for i in range(3)
     )
-    print("Adding final hits to figure")
-    fig.add_traces(finalhits_traces)
-
-    print("Plotting segments")
-    if prompthits_segs is not None:
-        segs_traces = plot_segs(
-            prompthits_segs[0, :, 0, 0],
-            sim_version=sim_version,
-            mode="lines",
-            name="edep segments",
-            visible="legendonly",
-            line_color="red",
-            showlegend=True,
-        )
-        print("Adding segments to figure")
-        fig.add_traces(segs_traces)
+    E = np.bincount(voxel, weights=E, minlength=n_voxels)
+    return x, y, z, E
 
-    # Draw the TPC
-    print("Drawing TPC")
-    tpc_center, anodes, cathodes = draw_tpc(sim_version)
-    light_detectors = draw_light_detectors(data, evid)
 
-    print("Adding TPC to figure")
-    fig.add_traces(tpc_center)
-    fig.add_traces(anodes)
-    fig.add_traces(cathodes)
-    print("Adding light detectors to figure")
-    fig.add_traces(light_detectors)
+def encode_hit_arrays(trace):
+    """Replace the coordinates and energies of a hits trace by float32 typed arrays"""
+    for axis in "xyz":
+        trace[axis] = to_typed_array(trace[axis])
+    trace["marker"]["color"] = to_typed_array(trace["marker"]["color"])
+
+
+def to_typed_array(array, dtype="f4"):
+    """
+    Encode an array in the typed array format of plotly.js: little-endian binary data
+    in base64, which is smaller than a list of numbers and faster to decode.
+    """
+    array = np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder("<"))
+    return {"dtype": dtype, "bdata": base64.b64encode(array.tobytes()).decode("ascii")}
+
 
-    return fig
+def is_zoomed_in(camera):
+    """Check if the camera of the 3D view is zoomed in enough to show all hits"""
+    eye = camera.get("eye", {})
+    distance = np.sqrt(sum(eye.get(axis, 0) ** 2 for axis in "xyz"))
+    return 0 < distance < ZOOM_FULL_RESOLUTION
 
 
 def plot_segs(segs, sim_version="minirun4", **kwargs):
@@ -163,7 +553,11 @@ def plot_segs(segs, sim_version="minirun4", **kwargs):
     return trace
 
 
-def draw_tpc(sim_version="minirun4"):
+def get_tpc_boundaries(sim_version="minirun4"):
+    """
+    Get the detector center and the x, y and z boundaries of the anode planes,
+    in the hit coordinates of the simulation format.
+    """
     anode_xs = np.array([-63.931, -3.069, 3.069, 63.931])
     anode_ys = np.array([-19.8543, 103.8543])  # two ys
     anode_zs = np.array([-64.3163, -2.6837, 2.6837, 64.3163])  # four zs
@@ -176,6 +570,11 @@ def draw_tpc(sim_version="minirun4"):
         anode_xs = anode_xs * 10
         anode_ys = anode_ys * 10
         anode_zs = anode_zs * 10
+    return detector_center, anode_xs, anode_ys, anode_zs
+
+
+def draw_tpc(sim_version="minirun4"):
+    detector_center, anode_xs, anode_ys, anode_zs = get_tpc_boundaries(sim_version)
 
     center = go.Scatter3d(
         x=[detector_center[0]],
@@ -228,123 +627,315 @@ def draw_anode_planes(x_boundaries, y_boundaries, z_boundaries, **kwargs):
 
 
 def draw_light_detectors(data, evid):
-    try:
-        charge = data["charge/events", evid][["id", "unix_ts"]]
-        num_light = data["light/events/data"].shape[0]
-        light = data["light/events", slice(0, num_light)][
-            ["id", "utime_ms"]
-        ]  # we have to try them all, events may not be time ordered
-    except:
+    """
+    Draw the light traps coloured by the light matched to the event. There is always
+    one light traps trace, which is hidden when there is no matched light.
+    """
+    schema = get_file_schema(data.filepath)
+    if not (schema.has_light and schema.has_geometry):
         print("No light information found, not plotting light detectors")
-        return []
+        return [dict(type="mesh3d", name="light traps", visible=False)]
 
-    match_light = match_light_to_charge_event(charge, light, evid)
+    light_data = get_light_data(data, evid)
 
-    if match_light is None:
+    if light_data is None:
         print(
             f"No light event matches found for charge event {evid}, not plotting light detectors"
         )
-        return []
-
-    waveforms_all_detectors = get_waveforms_all_detectors(data, match_light)
-
-    # make a list of the sum of the waveform and the channel index
-    integral = np.sum(np.sum(waveforms_all_detectors, axis=2), axis=0)
-    max_integral = np.max(integral)
-    index = np.arange(0, waveforms_all_detectors.shape[1], 1)
-
-    # plot for each of the 96 channels per tpc the sum of the adc values
+        # keep the geometry, so the light traps of later events only need new colours
+        index = np.arange(0, len(SIPM_CHANNELS), 1)
+        light_traps = plot_light_traps(data, np.zeros(len(index)), index, 1)
+        light_traps[0]["visible"] = False
+        return light_traps
+
+    # the baseline subtracted integral of the waveform for each channel and the channel index
+    integral = light_data.integral
+    max_integral = np.max(integral) if np.max(integral) > 0 else 1
+    index = np.arange(0, len(integral), 1)
+
+    # plot for each of the 96 channels per tpc the integral of the adc values
     drawn_objects = []
     drawn_objects.extend(plot_light_traps(data, integral, index, max_integral))
 
     return drawn_objects
 
 
-def match_light_to_charge_event(charge, light, evid):
+def get_light_data(data, evid):
+    """
+    Get the waveforms of all the light detectors for the light matched to a charge event,
+    together with the per-channel integrals. These are computed once per event and kept
+    in a cache, so the 3D view and the waveform plot share them.
+    Returns None if there is no light matched to the event.
+    """
+    key = (data.filepath, evid)
+    light_data = LIGHT_CACHE.get(key)
+    if light_data is MISSING:
+        light_data = load_light_data(data, evid)
+        LIGHT_CACHE.put(key, light_data)
+    return light_data
+
+
+def load_light_data(data, evid):
+    match_light = match_light_to_charge_event(data, evid)
+    if match_light is None:
+        return None
+
+    file_features = get_light_features(data.filepath)
+    if file_features is not None:
+        # precomputed, no need to read the waveforms
+        features = WaveformFeatures(*(feature[match_light] for feature in file_features))
+        waveforms_all_detectors = None
+    else:
+        waveforms_all_detectors = get_waveforms_all_detectors(data, match_light)
+        features = compute_waveform_features(waveforms_all_detectors)
+    integral = np.sum(features.integral, axis=0)
+    return LightData(match_light, waveforms_all_detectors, features, integral)
+
+
+def get_light_features(filename):
+    """
+    Get the waveform features of all the light events in a file from its sidecar files,
+    see compute_light_features. The (n, 384) arrays are memory mapped, so only the rows
+    that are used are read. Returns None if they were not computed.
+    """
+    try:
+        return _load_light_features(filename)
+    except FileNotFoundError:
+        # not cached, they may still be computed by another process, e.g. precompute.py
+        return None
+
+
+@functools.lru_cache(maxsize=8)
+def _load_light_features(filename):
+    features = {}
+    for name, path in light_feature_paths(filename).items():
+        features[name] = load_sidecar_array(path)
+        if features[name] is None:
+            raise FileNotFoundError(path)
+    return WaveformFeatures(**features)
+
+
+def light_feature_paths(filename):
+    """The sidecar file of every waveform feature of a file"""
+    return {
+        name: sidecar_path(filename, f"light_features_v{LIGHT_FEATURES_VERSION}_{name}.npy")
+        for name in WaveformFeatures._fields
+    }
+
+
+def compute_light_features(filename, executor=None):
+    """
+    Compute the waveform features of all the light events in a file, as (n, 384)
+    arrays, and store them as sidecar files. The features are written
+    to the files chunk by chunk, so they are never all in memory. The chunks are
+    computed with the executor when one is given, e.g. on several processes.
+    After this the light traps of the file are coloured without reading the waveforms.
+    Returns None if the file has no light information.
+    """
+    if not get_file_schema(filename).has_light:
+        return None
+    with open_flow_file(filename) as data:
+        n_light = data["light/wvfm/data"].shape[0]
+
+    paths = light_feature_paths(filename)
+    # write to temporary files first, so readers never see partial features
+    tmp_paths = {
+        name: str(path.with_name(f"{path.name}.{os.getpid()}.tmp"))
+        for name, path in paths.items()
+    }
+    Path(SIDECAR_FOLDER).mkdir(parents=True, exist_ok=True)
+    for name, tmp_path in tmp_paths.items():
+        shape = (n_light, len(SIPM_CHANNELS))
+        dtype = LIGHT_FEATURE_DTYPES[name]
+        np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape).flush()
+
+    tasks = [
+        (filename, tmp_paths, start, min(start + LIGHT_FEATURES_TASK, n_light))
+        for start in range(0, n_light, LIGHT_FEATURES_TASK)
+    ]
+    map_tasks = map if executor is None else executor.map
+    for stop in map_tasks(compute_light_features_task, *zip(*tasks)) if tasks else []:
+        print(f"Computed the waveform features of {stop}/{n_light} light events")
+
+    for name, path in paths.items():
+        os.replace(tmp_paths[name], path)
+    evict_sidecars()
+    _load_light_features.cache_clear()
+    return get_light_features(filename)
+
+
+def compute_light_features_task(filename, paths, start, stop):
+    """
+    Compute the waveform features of the light events in [start, stop) and write
+    them to the rows of the (memory mapped) feature files, LIGHT_FEATURES_CHUNK
+    light events at a time
+    """
+    outputs = {name: np.load(path, mmap_mode="r+") for name, path in paths.items()}
+    buffer = None
+    with open_flow_file(filename) as data:
+        for chunk_start in range(start, stop, LIGHT_FEATURES_CHUNK):
+            chunk_stop = min(chunk_start + LIGHT_FEATURES_CHUNK, stop)
+            waveforms = get_waveforms_all_detectors(data, np.arange(chunk_start, chunk_stop))
+            if buffer is None or len(buffer) != len(waveforms):
+                buffer = np.empty(waveforms.shape, dtype=np.float32)
+            features = compute_waveform_features(waveforms, buffer)
+            for name, values in features._asdict().items():
+                outputs[name][chunk_start:chunk_stop] = values
+    for output in outputs.values():
+        output.flush()
+    return stop
+
+
+@functools.lru_cache(maxsize=8)
+def get_light_index(filename):
+    """
+    Build the time index of the light events in a file, once per file.
+    The light events may not be time ordered, so we keep their unix times (in s)
+    sorted together with the permutation that sorts them.
+    Returns None if the file has no light information.
+    """
+    if not get_file_schema(filename).has_light:
+        return None
+    with open_flow_file(filename) as data:
+        light = data["light/events/data"]
+        ids = light["id"]
+        utime_ms = light["utime_ms"]
+
+    times = utime_ms.reshape(len(ids), -1)[:, 0] / 1000
+    order = np.argsort(times, kind="stable")
+    return LightIndex(times=times[order], order=order, ids=ids)
+
+
+def find_light_window(light_index, unix_ts, tolerance=LIGHT_MATCH_TOLERANCE):
+    """
+    Find the range [start, stop) in the sorted light times that lies within the
+    tolerance from the given charge event time(s).
+    """
+    start = np.searchsorted(light_index.times, unix_ts - tolerance, side="right")
+    stop = np.searchsorted(light_index.times, unix_ts + tolerance, side="left")
+    return start, np.maximum(start, stop)
+
+
+def match_light_to_charge_events(light_index, unix_ts, tolerance=LIGHT_MATCH_TOLERANCE):
+    """
+    Match the light events to many charge events at once, see match_light_to_charge_event.
+    Returns a CSR-style table: the ids of the light events matched to charge event i are
+    indices[offsets[i]:offsets[i + 1]], in file order.
+    """
+    start, stop = find_light_window(light_index, np.asarray(unix_ts), tolerance)
+    counts = stop - start
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    event = np.repeat(np.arange(len(counts)), counts)
+    position = np.arange(offsets[-1]) - offsets[event] + start[event]
+    indices = light_index.ids[light_index.order[position]]
+    # keep the light events in file order
+    indices = indices[np.lexsort((indices, event))]
+    return offsets, indices
+
+
+@functools.lru_cache(maxsize=8)
+def get_light_match_table(filename, tolerance=LIGHT_MATCH_TOLERANCE):
+    """
+    Get the light matches of all the charge events in a file, as (offsets, indices).
+    The table is computed in one pass and stored as a sidecar file in the cache,
+    so opening the same file again reuses it.
+    Returns None if the file has no light information.
+    """
+    path = sidecar_path(filename, f"light_match_{tolerance:g}s.npz")
+    table = load_sidecar(path)
+    if table is not None:
+        return table["offsets"], table["indices"]
+
+    light_index = get_light_index(filename)
+    if light_index is None:
+        return None
+    with open_flow_file(filename) as data:
+        unix_ts = data["charge/events/data"]["unix_ts"]
+
+    print(f"Matching light to all charge events in {filename}")
+    offsets, indices = match_light_to_charge_events(light_index, unix_ts, tolerance)
+    save_sidecar(path, offsets=offsets, indices=indices)
+    return offsets, indices
+
+
+def match_light_to_charge_event(data, evid, tolerance=LIGHT_MATCH_TOLERANCE):
     """
     Match the light events to the charge event by looking at proximity in time.
     Use unix time for this, since it should refer to the same time in both readout systems.
-    For now we just take all the light within 1s from the charge event time.
-    """
-    matches = []
-    for i in range(len(light)):
-        if np.abs(light["utime_ms"][i][0] / 1000 - charge["unix_ts"][0]) < 0.5:
-            matches.append([charge["id"][0], light["id"][i]])
-
-    match_light = []
-    for i in range(len(matches)):
-        if (
-            matches[i][0] == evid
-        ):  # just checking that we get light for the right charge event
-            match_light.append(matches[i][1])
+    For now we just take all the light within the tolerance (0.5s by default) from the charge
+    event time. The matches come from the match table of the file.
+    """
+    with span("light matching"):
+        table = get_light_match_table(data.filepath, tolerance)
+    if table is None:
+        return None
+
+    offsets, indices = table
+    match_light = indices[offsets[evid] : offsets[evid + 1]]
     if len(match_light) == 0:
-        match_light = None  # no light for this charge event
+        return None  # no light for this charge event
 
     return match_light
 
 
-def get_waveforms_all_detectors(data, match_light):
-    """
-    Get the light waveforms for the matched light events.
-    """
-    light_wvfm = data["/light/wvfm", match_light]
-
-    samples_mod0 = light_wvfm["samples"][:, 0:2, :, :]
-    samples_mod1 = light_wvfm["samples"][:, 2:4, :, :]
-    samples_mod2 = light_wvfm["samples"][:, 4:6, :, :]
-    samples_mod3 = light_wvfm["samples"][:, 6:8, :, :]
-
-    sipm_channels_module0 = np.array(
-        [2, 3, 4, 5, 6, 7]
-        + [9, 10]
-        + [11, 12]
-        + [13, 14]
-        + [18, 19, 20, 21, 22, 23]
-        + [25, 26]
-        + [27, 28]
-        + [29, 30]
-        + [34, 35, 36, 37, 38, 39]
-        + [41, 42]
-        + [43, 44]
-        + [45, 46]
-        + [50, 51, 52, 53, 54, 55]
-        + [57, 58]
-        + [59, 60]
-        + [61, 62]
-    )
-
-    sipm_channels_modules = np.array(
-        [4, 5, 6, 7, 8, 9]
-        + [10, 11, 12, 13, 14, 15]
-        + [20, 21, 22, 23, 24, 25]
-        + [26, 27, 28, 29, 30, 31]
-        + [36, 37, 38, 39, 40, 41]
-        + [42, 43, 44, 45, 46, 47]
-        + [52, 53, 54, 55, 56, 57]
-        + [58, 59, 60, 61, 62, 63]
-    )
-    adcs_mod0 = samples_mod0[:, :, sipm_channels_module0, :]
-    adcs_mod1 = samples_mod1[:, :, sipm_channels_modules, :]
-    adcs_mod2 = samples_mod2[:, :, sipm_channels_modules, :]
-    adcs_mod3 = samples_mod3[:, :, sipm_channels_modules, :]
+def get_waveforms_all_detectors(data, match_light, opids=None):
+    """
+    Get the light waveforms for the matched light events, as a (m, 384, 1000) array,
+    or (m, len(opids), 1000) when only some optical detectors are requested.
+    The light events are read a few at a time, and only the SiPM channels are
+    gathered from them straight into one preallocated output array.
+    """
+    light_wvfm = data["light/wvfm/data"]
+    samples = light_wvfm.fields("samples")
+    n_tpcs, n_channels, n_samples = light_wvfm.dtype["samples"].shape
 
-    all_adcs = np.concatenate((adcs_mod0, adcs_mod1, adcs_mod2, adcs_mod3), axis=1)
+    # index of the channel of every optical detector when the tpcs and channels are flattened
+    sipm_channels = SIPM_TPCS * n_channels + SIPM_CHANNELS
+    if opids is not None:
+        sipm_channels = sipm_channels[opids]
 
-    # instead of a (m, 8, 48, 1000) array, we want a (m, 4, 96, 1000) array
-    # modules instead of tpcs, and 96 channels per module
     m = len(match_light)
-    all_modules = all_adcs.reshape((m, 4, 96, 1000))
-
-    # now we make a full array for all the modules
-    # could have been done in one step, but this is easier to read
-    all_detector = all_modules.reshape((m, 384, 1000))
+    all_detector = np.empty(
+        (m, len(sipm_channels), n_samples), dtype=light_wvfm.dtype["samples"].base
+    )
+    with span("waveform read"):
+        for start in range(0, m, WAVEFORM_READ_CHUNK):
+            rows = np.asarray(match_light[start : start + WAVEFORM_READ_CHUNK])
+            if rows[-1] - rows[0] == len(rows) - 1:  # contiguous, read as a slice
+                rows = slice(rows[0], rows[-1] + 1)
+            chunk = samples[rows]
+            np.take(
+                chunk.reshape((len(chunk), n_tpcs * n_channels, n_samples)),
+                sipm_channels,
+                axis=1,
+                out=all_detector[start : start + len(chunk)],
+            )
 
     return all_detector
 
 
-def plot_light_traps(data, n_photons, op_indeces, max_integral):
-    """Plot optical detectors"""
-    drawn_objects = []
+def get_light_trap_geometry(data):
+    """
+    Get the corners of all the optical detectors, see draw_light_trap_geometry.
+    These only depend on the detector geometry, so they are computed once for every
+    geometry and only get their colour and hover text per event.
+    """
+    with span("geometry"):
+        det_bounds = data["/geometry_info/det_bounds/data"][()]
+        key = det_bounds.tobytes()
+        if key not in LIGHT_TRAP_GEOMETRY:
+            LIGHT_TRAP_GEOMETRY[key] = draw_light_trap_geometry(det_bounds)
+    return LIGHT_TRAP_GEOMETRY[key]
+
+
+def draw_light_trap_geometry(det_bounds):
+    """
+    Compute the rectangles of the optical detectors of all tpcs at once.
+    Returns the opids and the x, y and z of the 4 corners of every rectangle,
+    as (n,) and (n, 4) arrays.
+    """
     ys = np.flip(
         np.array(
             [
@@ -378,77 +969,117 @@ def plot_light_traps(data, n_photons, op_indeces, max_integral):
     )
     light_width = ys[1] - ys[0]
 
-    det_bounds = data["/geometry_info/det_bounds/data"]
-    COLORSCALE = plotly.colors.make_colorscale(
-        plotly.colors.convert_colors_to_same_type(plotly.colors.sequential.YlOrRd)[0]
+    # opid = ilight + iside * 24 + ix * 48
+    opid = np.arange(det_bounds.shape[0] * len(ys) * 2)
+    ix = opid // (len(ys) * 2)
+    iside = (opid // len(ys)) % 2
+    ilight = opid % len(ys)
+
+    bounds = np.array([det_bounds[i][0] for i in range(det_bounds.shape[0])])
+    x_low = bounds[ix, 0, 0] / 10
+    x_high = bounds[ix, 1, 0] / 10
+    # the odd tpcs are flipped
+    flip = np.where(ix % 2 == 0, 0, -1)
+    y = bounds[ix, 0, (iside + flip) % 3] / 10 - 240
+    # the rectangle spans all the z edges offset by the bounds of the first tpc
+    z_offset = np.atleast_1d(det_bounds[0][0][1])
+    z_edges = np.concatenate(
+        [
+            ys[ilight, None] - light_width / 2 + z_offset + 0.25,
+            ys[ilight, None] + light_width / 2 + z_offset - 0.25,
+        ],
+        axis=1,
     )
+    z_low = z_edges.min(axis=1) / 10 + 1300
+    z_high = z_edges.max(axis=1) / 10 + 1300
 
-    for ix in range(0, det_bounds.shape[0]):
-        for ilight, light_y in enumerate(ys):
-            for iside in range(2):
-                opid = ilight + iside * len(ys) + ix * len(ys) * 2
-                if opid not in op_indeces:
-                    continue
-                xx = np.linspace(det_bounds[ix][0][0][0], det_bounds[ix][0][1][0], 2)
-                zz = np.linspace(
-                    light_y - light_width / 2 + det_bounds[0][0][1] + 0.25,
-                    light_y + light_width / 2 + det_bounds[0][0][1] - 0.25,
-                    2,
-                )
-
-                xx, zz = np.meshgrid(xx, zz)
-                light_color = [
-                    [
-                        0.0,
-                        get_continuous_color(
-                            COLORSCALE, intermed=max(0, n_photons[opid]) / max_integral
-                        ),
-                    ],
-                    [
-                        1.0,
-                        get_continuous_color(
-                            COLORSCALE, intermed=max(0, n_photons[opid]) / max_integral
-                        ),
-                    ],
-                ]
+    x = np.stack([x_low, x_high, x_high, x_low], axis=1)
+    y = np.repeat(y[:, None], 4, axis=1)
+    z = np.stack([z_low, z_low, z_high, z_high], axis=1)
+    return opid, x, y, z
 
-                if ix % 2 == 0:
-                    flip = 0
-                else:
-                    flip = -1
-
-                opid_str = f"opid_{opid}"
-                light_plane = dict(
-                    type="surface", 
-                    y=np.full(xx.shape, det_bounds[ix][0][0][iside + flip])/10 -240,
-                    x=xx/10,
-                    z=zz/10+1300,
-                    opacity=0.4,
-                    hoverinfo="text",
-                    ids=[[opid_str, opid_str], [opid_str, opid_str]],
-                    customdata=[[opid_str, opid_str], [opid_str, opid_str]],
-                    text=f"Optical detector {opid} waveform integral<br>{n_photons[opid]:.2e}",
-                    colorscale=light_color,
-                    showlegend=False,
-                    showscale=False,
-                )
-
-                drawn_objects.append(light_plane)
 
-    return drawn_objects
+def plot_light_traps(data, n_photons, op_indeces, max_integral):
+    """
+    Plot optical detectors, as one mesh with two triangles per detector,
+    coloured by the waveform integral.
+    """
+    opid, x, y, z = get_light_trap_geometry(data)
+    drawn = np.isin(opid, op_indeces)
+    opid, x, y, z = opid[drawn], x[drawn], y[drawn], z[drawn]
+
+    colors = get_continuous_colors(
+        COLORSCALE, np.maximum(0, n_photons[opid]) / max_integral
+    )
+    text = [
+        f"Optical detector {i} waveform integral<br>{n:.2e}"
+        for i, n in zip(opid, n_photons[opid])
+    ]
+    corners = 4 * np.arange(len(opid))
+    light_traps = dict(
+        type="mesh3d",
+        x=x.ravel(),
+        y=y.ravel(),
+        z=z.ravel(),
+        i=np.stack([corners, corners], axis=1).ravel(),
+        j=np.stack([corners + 1, corners + 2], axis=1).ravel(),
+        k=np.stack([corners + 2, corners + 3], axis=1).ravel(),
+        facecolor=np.repeat(colors, 2),
+        opacity=0.4,
+        flatshading=True,
+        hoverinfo="text",
+        text=np.repeat(text, 4),
+        customdata=np.repeat(opid, 4),  # the opid of every corner
+        name="light traps",
+        visible=True,
+        showlegend=False,
+        showscale=False,
+    )
+
+    return [light_traps]
+
+
+@functools.lru_cache(maxsize=4)
+def get_tpc_traces(sim_version="minirun4"):
+    """
+    Get the traces of the TPC center, anode and cathode planes as dicts.
+    These are the same for every event, so they are built (and validated) once.
+    """
+    tpc_center, anodes, cathodes = draw_tpc(sim_version)
+    return [trace.to_plotly_json() for trace in [tpc_center, *anodes, *cathodes]]
+
 
 def plot_waveform(data, evid, opid):
-    try:
-        charge = data["charge/events", evid][["id", "unix_ts"]]
-        num_light = data["light/events/data"].shape[0]
-        light = data["light/events", slice(0, num_light)][
-            ["id", "utime_ms"]
-        ]  # we have to try them all, events may not be time ordered
-    except:
+    """Plot the waveform of one optical detector, see plot_waveforms"""
+    return plot_waveforms(data, evid, [opid])
+
+
+def plot_waveforms(data, evid, opids, stack=False, pixels=None):
+    """
+    Plot the summed, baseline subtracted waveforms of the light matched to an event
+    for the given optical detectors, overlaid or stacked above each other. Every
+    waveform is decimated to the minimum and maximum per pixels // 2 buckets, where
+    pixels is the width of the plot (WAVEFORM_PIXELS by default).
+    """
+    if not get_file_schema(data.filepath).has_light:
         print("No light information found, not plotting light waveform")
         return []
 
-    match_light = match_light_to_charge_event(charge, light, evid)
+    opids = np.asarray(opids)
+    light_data = LIGHT_CACHE.get((data.filepath, evid))
+    if light_data is MISSING or (light_data is not None and light_data.waveforms is None):
+        # not displayed yet or only the features are cached,
+        # only read the waveforms of these optical detectors
+        match_light = match_light_to_charge_event(data, evid)
+        if match_light is not None:
+            wvfm_opids = get_waveforms_all_detectors(data, match_light, opids=opids)
+            baseline = compute_waveform_features(wvfm_opids).baseline
+    elif light_data is not None:
+        match_light = light_data.match_light
+        wvfm_opids = light_data.waveforms[:, opids, :]
+        baseline = light_data.features.baseline[:, opids]
+    else:
+        match_light = None
 
     if match_light is None:
         print(
@@ -456,26 +1087,51 @@ def plot_waveform(data, evid, opid):
         )
         return []
 
-    fig = go.Figure()
-    waveforms_all_detectors = get_waveforms_all_detectors(data, match_light)
-    wvfm_opid = waveforms_all_detectors[:, opid, :]
-    
-    x = np.arange(0, 1000, 1)
-    y = np.sum(wvfm_opid, axis=0)
-    drawn_objects = go.Scatter(x=x, y=y)
-    fig.add_traces(drawn_objects)
-    
-    fig.update_xaxes(title_text='Time [ticks] (1 ns)')
-    fig.update_yaxes(title_text='Adc counts')
-    fig.update_layout(title_text=f'Waveform for optical detector {opid}')
-    return fig
-
+    # the sum of the baseline subtracted waveforms of the matched light events
+    y = np.sum(wvfm_opids - baseline[:, :, None], axis=0, dtype=np.float32)
+    x, y = decimate_minmax(y, max(1, (pixels or WAVEFORM_PIXELS) // 2))
+    offsets = np.zeros(len(opids))
+    if stack and len(opids) > 1:
+        spacing = 1.1 * np.max(np.ptp(y, axis=1)) or 1
+        offsets = spacing * np.arange(len(opids))
+
+    # dicts instead of go.Scatter, to skip validating up to 384 traces
+    traces = [
+        dict(
+            type="scatter",
+            x=x[i],
+            y=y[i] + offsets[i],
+            mode="lines",
+            name=f"opid {opid}",
+            hovertemplate=f"opid {opid}<br>tick %{{x}}<extra></extra>",
+        )
+        for i, opid in enumerate(opids)
+    ]
+    layout = dict(
+        xaxis=dict(title=dict(text="Time [ticks] (1 ns)")),
+        yaxis=dict(title=dict(text="Adc counts above baseline")),
+        showlegend=1 < len(opids) <= 16,
+    )
+    if len(opids) == 1:
+        layout["title"] = dict(text=f"Waveform for optical detector {opids[0]}")
+    else:
+        layout["title"] = dict(
+            text=f"Waveforms for optical detectors {opids.min()}-{opids.max()}"
+        )
+    if stack and len(opids) > 1:
+        # label the stacked waveforms by their opid
+        layout["yaxis"] = dict(
+            title=dict(text="Optical detector"),
+            tickvals=offsets.tolist(),
+            ticktext=[str(opid) for opid in opids],
+        )
+    return dict(data=traces, layout=layout)
 
 
-def get_continuous_color(colorscale, intermed):
+def get_continuous_colors(colorscale, intermed):
     """
     Plotly continuous colorscales assign colors to the range [0, 1]. This function computes the intermediate
-    color for any value in that range.
+    colors for an array of values in that range, interpolating the RGB values of the colorscale.
 
     Plotly doesn't make the colorscales directly accessible in a common format.
     Some are ready to use:
@@ -488,29 +1144,22 @@ def get_continuous_color(colorscale, intermed):
         colorscale = plotly.colors.make_colorscale(viridis_colors, scale=scale)
 
     :param colorscale: A plotly continuous colorscale defined with RGB string colors.
-    :param intermed: value in the range [0, 1]
-    :return: color in rgb string format
-    :rtype: str
+    :param intermed: array of values in the range [0, 1]
+    :return: colors in rgb string format
+    :rtype: numpy array of str
     """
     if len(colorscale) < 1:
         raise ValueError("colorscale must have at least one color")
 
-    if intermed <= 0 or len(colorscale) == 1:
-        return colorscale[0][1]
-    if intermed >= 1:
-        return colorscale[-1][1]
+    cutoffs, rgb = get_colorscale_table(tuple(map(tuple, colorscale)))
+    intermed = np.nan_to_num(np.asarray(intermed, dtype=float))
+    channels = [np.interp(intermed, cutoffs, rgb[:, i]).tolist() for i in range(3)]
+    return np.array([f"rgb({r}, {g}, {b})" for r, g, b in zip(*channels)])
 
-    for cutoff, color in colorscale:
-        if intermed > cutoff:
-            low_cutoff, low_color = cutoff, color
-        if intermed <= cutoff:
-            high_cutoff, high_color = cutoff, color
-            break
 
-    # noinspection PyUnboundLocalVariable
-    return plotly.colors.find_intermediate_color(
-        lowcolor=low_color,
-        highcolor=high_color,
-        intermed=((intermed - low_cutoff) / (high_cutoff - low_cutoff)),
-        colortype="rgb",
-    )
+@functools.lru_cache(maxsize=8)
+def get_colorscale_table(colorscale):
+    """The cutoffs and the RGB values of a colorscale as arrays"""
+    cutoffs = np.array([cutoff for cutoff, _ in colorscale], dtype=float)
+    rgb = np.array([plotly.colors.unlabel_rgb(color) for _, color in colorscale], dtype=float)
+    return cutoffs, rgb
@@ -0,0 +1,310 @@
+"""
+Utility functions for managing the flow files opened by the app
+"""
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+
+# TODO: remove dependency on h5flow
+import h5flow
+import numpy as np
+
+from cache_utils import evict_lru_files
+from timing_utils import span
+
+# maximum number of file handles that are kept open when idle
+MAX_OPEN_FILES = 4
+# sidecar files with precomputed tables, in their own folder so they are kept when the
+# app removes its uploads, set with the EVD_SIDECAR_FOLDER environment variable
+SIDECAR_FOLDER = os.environ.get("EVD_SIDECAR_FOLDER", "sidecars")
+# the least recently used sidecar files are removed once they take more than this
+SIDECAR_FOLDER_BYTES = 20 * 1024**3
+# the content hash is computed from this many blocks spread over the file
+HASH_BLOCKS = 16
+HASH_BLOCK_SIZE = 1024 * 1024
+# the blocks are mostly light waveforms, so the hash also covers the shape and this
+# many rows spread over every charge dataset the display is made of
+HASH_DATASETS = [
+    "charge/events/data",
+    "charge/calib_prompt_hits/data",
+    "charge/calib_final_hits/data",
+]
+HASH_ROWS = 64
+
+# truth datasets of the simulation formats, in the order they are looked for
+TRUTH_DATASETS = {
+    "minirun4": "mc_truth/segments",  # called segments in minirun4
+    "minirun3": "mc_truth/tracks",  # called tracks in minirun3
+}
+# what is in a flow file, see get_file_schema
+FileSchema = namedtuple(
+    "FileSchema",
+    [
+        "sim_version",  # format of the truth, None for data
+        "truth_dataset",  # dataset with the truth segments, None for data
+        "layout",  # coordinate system of the hits, as the simulation format
+        "length_unit",  # unit of the hit coordinates
+        "has_truth",
+        "has_light",
+        "has_geometry",
+    ],
+)
+
+
+class FilePool:
+    """
+    Process-wide pool of open H5FlowDataManager handles, keyed by file path.
+
+    Opening a flow file is expensive, so handles are kept open between callbacks.
+    A handle is reference counted while it is in use, and once more than
+    max_open handles are open the least recently used idle ones are closed.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_FILES):
+        self.max_open = max_open
+        self._handles = OrderedDict()  # filename -> [data, refcount]
+        self._lock = threading.RLock()
+
+    def acquire(self, filename):
+        """Get an open handle for the file and increase its reference count"""
+        with self._lock:
+            entry = self._handles.get(filename)
+            if entry is None:
+                print(f"Opening {filename}")
+                with span("file open"):
+                    entry = [h5flow.data.H5FlowDataManager(filename, "r"), 0]
+                self._handles[filename] = entry
+            entry[1] += 1
+            self._handles.move_to_end(filename)
+            self._evict()
+            return entry[0]
+
+    def release(self, filename):
+        """Decrease the reference count of the file, it may be closed afterwards"""
+        with self._lock:
+            entry = self._handles.get(filename)
+            if entry is None:
+                return
+            entry[1] = max(0, entry[1] - 1)
+            self._evict()
+
+    def set_max_open(self, max_open):
+        """Change the number of handles kept open"""
+        with self._lock:
+            self.max_open = max_open
+            self._evict()
+
+    def close(self, filename):
+        """Close the handle for the file, even if it is still in use"""
+        with self._lock:
+            entry = self._handles.pop(filename, None)
+            if entry is not None:
+                _close_handle(filename, entry[0])
+
+    def close_all(self):
+        """Close all open handles"""
+        with self._lock:
+            for filename in list(self._handles):
+                self.close(filename)
+
+    def __contains__(self, filename):
+        return filename in self._handles
+
+    def __len__(self):
+        return len(self._handles)
+
+    def _evict(self):
+        # close least recently used handles that are not in use anymore
+        for filename in list(self._handles):
+            if len(self._handles) <= self.max_open:
+                break
+            if self._handles[filename][1] == 0:
+                _close_handle(filename, self._handles.pop(filename)[0])
+
+
+def _close_handle(filename, data):
+    print(f"Closing {filename}")
+    try:
+        data.close_file()
+    except Exception as err:
+        print(f"Can't close {filename} : {err}")
+
+
+FILE_POOL = FilePool()
+
+
+@contextmanager
+def open_flow_file(filename):
+    """
+    Get a handle for a flow file from the pool. The handle stays open
+    for at least as long as the context is active.
+    """
+    data = FILE_POOL.acquire(filename)
+    try:
+        yield data
+    finally:
+        FILE_POOL.release(filename)
+
+
+@functools.lru_cache(maxsize=64)
+def get_file_schema(filename):
+    """
+    Find out once per file what it contains: the truth format (if any), light
+    events and waveforms, and the detector geometry. The display functions use
+    this instead of trying the reference chains of every format for every event.
+    """
+    with open_flow_file(filename) as data:
+        sim_version = None
+        for version, truth_dataset in TRUTH_DATASETS.items():
+            if has_dataset(data, f"{truth_dataset}/data") and has_dataset(
+                data, f"charge/packets/ref/{truth_dataset}/ref"
+            ):
+                sim_version = version
+                print(f"Found truth info in {version} format")
+                break
+        else:
+            truth_dataset = None
+            print("No truth info found")
+
+        has_light = has_dataset(data, "light/events/data") and has_dataset(
+            data, "light/wvfm/data"
+        )
+        has_geometry = has_dataset(data, "geometry_info/det_bounds/data")
+
+    # data files have the hits in cm, like minirun4
+    layout = sim_version or "minirun4"
+    return FileSchema(
+        sim_version=sim_version,
+        truth_dataset=truth_dataset,
+        layout=layout,
+        length_unit="mm" if layout == "minirun3" else "cm",
+        has_truth=sim_version is not None,
+        has_light=has_light,
+        has_geometry=has_geometry,
+    )
+
+
+def has_dataset(data, path):
+    try:
+        data[path]
+    except KeyError:
+        return False
+    return True
+
+
+class RunIndex:
+    """
+    Global event IDs over the flow files of a run, in the order the files are given.
+    Only the number of events of every file is kept, the files themselves are opened
+    from the pool when their events are displayed.
+    """
+
+    def __init__(self, filenames, num_events):
+        self.filenames = list(filenames)
+        self.num_events = [int(n) for n in num_events]
+        # global event ID of the first event of every file, and the total
+        self.offsets = np.zeros(len(self.filenames) + 1, dtype=np.int64)
+        np.cumsum(self.num_events, out=self.offsets[1:])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def locate(self, evid):
+        """Get the file and the event ID within it of a global event ID"""
+        i = int(np.searchsorted(self.offsets, evid, side="right")) - 1
+        i = min(max(i, 0), len(self.filenames) - 1)
+        return self.filenames[i], int(evid - self.offsets[i])
+
+    def global_evid(self, filename, evid):
+        """Get the global event ID of an event in one of the files"""
+        return int(self.offsets[self.filenames.index(filename)] + evid)
+
+    def to_dict(self):
+        return {"filenames": self.filenames, "num_events": self.num_events}
+
+
+def file_content_hash(filename):
+    """
+    Hash identifying the contents of a file, used to find the sidecar files
+    of a file that was uploaded before.
+    """
+    stat = os.stat(filename)
+    return _file_content_hash(str(filename), stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=64)
+def _file_content_hash(filename, size, mtime_ns):
+    # flow files are many GB, so instead of reading everything we hash the size
+    # and a number of blocks spread evenly over the file
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(filename, "rb") as f:
+        for offset in np.linspace(0, max(0, size - HASH_BLOCK_SIZE), HASH_BLOCKS):
+            f.seek(int(offset))
+            digest.update(f.read(HASH_BLOCK_SIZE))
+    # the light waveforms take nearly all the bytes, so the blocks hardly ever see the
+    # hits, which can change (e.g. when the charge is reprocessed) without the size
+    with open_flow_file(filename) as data:
+        for path in HASH_DATASETS:
+            if not has_dataset(data, path):
+                continue
+            dataset = data[path]
+            digest.update(f"{path} {dataset.shape} {dataset.dtype}".encode())
+            if len(dataset):
+                rows = np.unique(np.linspace(0, len(dataset) - 1, HASH_ROWS).astype(int))
+                digest.update(np.ascontiguousarray(dataset[rows]).tobytes())
+    return digest.hexdigest()
+
+
+def sidecar_path(filename, kind):
+    """Path of the sidecar file of the given kind for a flow file"""
+    return Path(SIDECAR_FOLDER) / f"{file_content_hash(filename)}_{kind}"
+
+
+def load_sidecar(path):
+    """Load the arrays stored in an .npz sidecar file, or None if it does not exist"""
+    try:
+        with np.load(path) as arrays:
+            sidecar = {key: arrays[key] for key in arrays.files}
+        os.utime(path)  # mark as recently used for the eviction
+    except (OSError, ValueError):
+        return None
+    return sidecar
+
+
+def load_sidecar_array(path):
+    """
+    Memory map the array stored in an .npy sidecar file,
+    or None if it does not exist
+    """
+    try:
+        array = np.load(path, mmap_mode="r")
+        os.utime(path)  # mark as recently used for the eviction
+    except (OSError, ValueError):
+        return None
+    return array
+
+
+def save_sidecar(path, **arrays):
+    """Store arrays in an .npz sidecar file"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first, so readers never see a partial file
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+    evict_sidecars()
+
+
+def evict_sidecars():
+    """Remove the least recently used sidecar files once they take too much space"""
+    paths = [
+        path
+        for path in Path(SIDECAR_FOLDER).glob("*")
+        if path.is_file() and not path.name.endswith(".tmp")
+    ]
+    evict_lru_files(paths, SIDECAR_FOLDER_BYTES)
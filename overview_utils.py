@@ -0,0 +1,331 @@
+"""
+Utility functions for the run overview: data quality views of a whole file, computed
+in one streaming pass over the hits and the light
+"""
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import plotly.io as pio
+
+from display_utils import (
+    COLORSCALE,
+    SIPM_CHANNELS,
+    compute_light_features,
+    get_light_features,
+    get_light_match_table,
+    get_tpc_boundaries,
+)
+from file_utils import get_file_schema, load_sidecar, open_flow_file, save_sidecar, sidecar_path
+from summary_utils import get_event_summary
+from timing_utils import span
+
+# number of hits read at a time, every worker holds one chunk in memory
+OVERVIEW_HIT_CHUNK = 1024**2
+# number of light events of which the integrals are read at a time
+OVERVIEW_LIGHT_CHUNK = 16384
+# number of processes the chunks are spread over, 1 computes them in this process
+OVERVIEW_WORKERS = min(4, os.cpu_count() or 1)
+# bump when the contents of the overview change, so old sidecar files are not used
+OVERVIEW_VERSION = 2
+# number of (y, z) bins of the occupancy of every anode
+OCCUPANCY_BINS = (124, 62)
+# log10 bins of the light integrals, in adc counts x ticks
+LIGHT_INTEGRAL_BINS = np.linspace(0, 7, 71)
+# bins of the charge (log10 MeV) and the light (log10 adc counts x ticks) of the events
+CHARGE_BINS = np.linspace(0, 4, 41)
+LIGHT_BINS = np.linspace(3, 9, 61)
+# width of the bins of the event rate, in s
+EVENT_RATE_BIN = 10
+# the event rate only covers the events within this time (in s) from the median time,
+# so a few events with a wrong time (e.g. 0) don't stretch it over years of empty bins
+EVENT_RATE_MAX_SPAN = 7 * 24 * 3600
+
+
+@functools.lru_cache(maxsize=4)
+def get_run_overview(filename, workers=OVERVIEW_WORKERS):
+    """
+    Get the run overview of a file as a dict of arrays: the hit occupancy of every
+    anode, the distribution of the light integral of every optical detector, the
+    event rate and the charge of the events against their light. Only one chunk of
+    hits or waveforms is in memory per worker, and the histograms are stored as a
+    sidecar file. The light integrals come from the waveform features of the file,
+    which are computed and stored on the way when they were not yet.
+    """
+    path = sidecar_path(filename, f"run_overview_v{OVERVIEW_VERSION}.npz")
+    overview = load_sidecar(path)
+    if overview is not None:
+        return overview
+
+    print(f"Computing the run overview of {filename}")
+    schema = get_file_schema(filename)
+    with open_flow_file(filename) as data:
+        n_hits = data["charge/calib_prompt_hits/data"].shape[0]
+        unix_ts = data["charge/events/data"]["unix_ts"]
+
+    hit_chunks = [
+        (filename, start, min(start + OVERVIEW_HIT_CHUNK, n_hits))
+        for start in range(0, n_hits, OVERVIEW_HIT_CHUNK)
+    ]
+    with span("run overview"):
+        overview = {"occupancy": np.zeros((8, *OCCUPANCY_BINS), dtype=np.int64)}
+        features = None
+        with get_executor(workers) as executor:
+            hit_results = executor.map(occupancy_chunk, *zip(*hit_chunks)) if hit_chunks else []
+            if schema.has_light:
+                # the light integrals are the waveform features the light traps are
+                # coloured with, so the waveforms are read once for both
+                features = get_light_features(filename)
+                if features is None:
+                    features = compute_light_features(filename, executor)
+            for i, occupancy in enumerate(hit_results):
+                overview["occupancy"] += occupancy
+                print(f"Filled the occupancy with {hit_chunks[i][2]}/{n_hits} hits")
+
+        light_hist, light_total = summarise_light_integrals(
+            np.zeros((0, len(SIPM_CHANNELS))) if features is None else features.integral
+        )
+        overview["rate_edges"], overview["rate"] = event_rate(unix_ts)
+        overview["light_hist"] = light_hist
+        overview["charge_light"] = charge_light_histogram(
+            get_event_summary(filename)["E"], event_light(filename, light_total)
+        )
+
+    save_sidecar(path, **overview)
+    return overview
+
+
+class InProcessExecutor:
+    """Run the chunks in this process, with the map of an executor"""
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def get_executor(workers):
+    """
+    Get the executor the chunks are computed with. The worker processes are spawned
+    instead of forked, so they don't share the open file handles of this process.
+    """
+    if workers <= 1:
+        return InProcessExecutor()
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def occupancy_chunk(filename, start, stop):
+    """Histogram the (y, z) positions of the hits start to stop on every anode"""
+    layout = get_file_schema(filename).layout
+    with open_flow_file(filename) as data:
+        hits = data["charge/calib_prompt_hits/data"].fields(["x", "y", "z"])[start:stop]
+    return histogram_occupancy(hits, layout)
+
+
+def histogram_occupancy(hits, layout="minirun4"):
+    """
+    Histogram the hits in (y, z) bins on the anode of the TPC they are in,
+    as an (8, n_y, n_z) array. TPC i has its anode at the i % 4 th anode x and
+    covers the i // 4 th half of the modules in z.
+    """
+    _, anode_xs, anode_ys, anode_zs = get_tpc_boundaries(layout)
+    n_y, n_z = OCCUPANCY_BINS
+    # the TPCs of a module are split by its cathode, halfway between the anodes
+    ix = np.searchsorted((anode_xs[:-1] + anode_xs[1:]) / 2, hits["x"])
+    iz = (hits["z"] > (anode_zs[1] + anode_zs[2]) / 2).astype(np.intp)
+    z_low = anode_zs[2 * iz]
+    z_high = anode_zs[2 * iz + 1]
+    iy = np.floor((hits["y"] - anode_ys[0]) / (anode_ys[1] - anode_ys[0]) * n_y).astype(np.intp)
+    iz_bin = np.floor((hits["z"] - z_low) / (z_high - z_low) * n_z).astype(np.intp)
+    inside = (iy >= 0) & (iy < n_y) & (iz_bin >= 0) & (iz_bin < n_z)
+
+    tpc = iz * 4 + ix
+    index = (tpc * n_y + iy) * n_z + iz_bin
+    counts = np.bincount(index[inside], minlength=8 * n_y * n_z)
+    return counts.reshape(8, n_y, n_z)
+
+
+def summarise_light_integrals(integral):
+    """
+    Histogram the (memory mapped) (n, 384) light integrals per optical detector and
+    sum them per light event, reading OVERVIEW_LIGHT_CHUNK light events at a time
+    """
+    hist = np.zeros((integral.shape[1], len(LIGHT_INTEGRAL_BINS) - 1), dtype=np.int64)
+    total = np.zeros(len(integral))
+    for start in range(0, len(integral), OVERVIEW_LIGHT_CHUNK):
+        chunk = np.asarray(integral[start : start + OVERVIEW_LIGHT_CHUNK])
+        hist += histogram_light_integrals(chunk)
+        total[start : start + len(chunk)] = np.sum(chunk, axis=1)
+    return hist, total
+
+
+def histogram_light_integrals(integral):
+    """Histogram the (m, 384) light integrals per optical detector in LIGHT_INTEGRAL_BINS"""
+    n_bins = len(LIGHT_INTEGRAL_BINS) - 1
+    log_integral = np.log10(np.maximum(integral, 1))
+    i_bin = np.searchsorted(LIGHT_INTEGRAL_BINS, log_integral, side="right") - 1
+    i_bin = np.clip(i_bin, 0, n_bins - 1)  # the overflow goes in the last bin
+    index = np.arange(integral.shape[1]) * n_bins + i_bin
+    counts = np.bincount(index.ravel(), minlength=integral.shape[1] * n_bins)
+    return counts.reshape(integral.shape[1], n_bins)
+
+
+def event_rate(unix_ts):
+    """
+    The rate of the charge events in Hz, in EVENT_RATE_BIN bins of their unix time.
+    Events without a time, or more than EVENT_RATE_MAX_SPAN from the median time,
+    are left out.
+    """
+    unix_ts = np.asarray(unix_ts, dtype=np.float64)
+    valid = unix_ts > 0
+    if valid.any():
+        valid &= np.abs(unix_ts - np.median(unix_ts[valid])) <= EVENT_RATE_MAX_SPAN
+    if not valid.all():
+        print(f"Left {np.count_nonzero(~valid)} events with an invalid time out of the event rate")
+        unix_ts = unix_ts[valid]
+    if len(unix_ts) == 0:
+        return np.zeros(1), np.zeros(0)
+    start = np.floor(unix_ts.min())
+    n_bins = int((unix_ts.max() - start) // EVENT_RATE_BIN) + 1
+    edges = start + EVENT_RATE_BIN * np.arange(n_bins + 1)
+    counts = np.bincount(((unix_ts - start) // EVENT_RATE_BIN).astype(np.intp), minlength=n_bins)
+    return edges, counts / EVENT_RATE_BIN
+
+
+def event_light(filename, light_total):
+    """The total light integral of the light matched to every charge event"""
+    table = get_light_match_table(filename)
+    if table is None:
+        return None
+    offsets, indices = table
+    event = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return np.bincount(event, weights=light_total[indices], minlength=len(offsets) - 1)
+
+
+def charge_light_histogram(energy, light):
+    """Histogram the charge (GeV) of the events against their light, in log10 bins"""
+    if light is None:
+        return np.zeros((len(CHARGE_BINS) - 1, len(LIGHT_BINS) - 1), dtype=np.int64)
+    both = (energy > 0) & (light > 0)
+    hist, _, _ = np.histogram2d(
+        np.log10(energy[both] * 1000), np.log10(light[both]), bins=(CHARGE_BINS, LIGHT_BINS)
+    )
+    return hist.astype(np.int64)
+
+
+def get_overview_json(filename, workers=OVERVIEW_WORKERS):
+    """The figures of the run overview of a file as JSON, by name"""
+    overview = get_run_overview(filename, workers)
+    schema = get_file_schema(filename)
+    figures = {
+        "occupancy": plot_occupancy(overview["occupancy"], schema.layout, schema.length_unit),
+        "light": plot_light_integrals(overview["light_hist"]),
+        "rate": plot_event_rate(overview["rate_edges"], overview["rate"]),
+        "charge-light": plot_charge_light(overview["charge_light"]),
+    }
+    return pio.to_json(figures, validate=False)
+
+
+def plot_occupancy(occupancy, layout="minirun4", length_unit="cm"):
+    """Plot the hit occupancy of the 8 anodes as heatmaps, in a 2 by 4 grid"""
+    _, anode_xs, anode_ys, anode_zs = get_tpc_boundaries(layout)
+    n_y, n_z = OCCUPANCY_BINS
+    y = np.linspace(*anode_ys, n_y + 1)
+    y = (y[:-1] + y[1:]) / 2
+    traces = []
+    fig_layout = dict(
+        title=dict(text="Hit occupancy per anode"),
+        coloraxis=dict(colorscale=COLORSCALE, colorbar=dict(title=dict(text="Hits"))),
+    )
+    for tpc in range(8):
+        ix, iz = tpc % 4, tpc // 4
+        z = np.linspace(anode_zs[2 * iz], anode_zs[2 * iz + 1], n_z + 1)
+        traces.append(
+            dict(
+                type="heatmap",
+                x=(z[:-1] + z[1:]) / 2,
+                y=y,
+                z=occupancy[tpc],
+                coloraxis="coloraxis",
+                xaxis=f"x{tpc + 1}",
+                yaxis=f"y{tpc + 1}",
+                hovertemplate=f"anode x = {anode_xs[ix]:.0f}<br>z %{{x:.1f}}<br>"
+                "y %{y:.1f}<br>%{z} hits<extra></extra>",
+            )
+        )
+        # 4 columns for the anode x, 2 rows for the z halves
+        x_domain = [ix / 4 + 0.01, (ix + 1) / 4 - 0.01]
+        y_domain = [(1 - iz) / 2 + 0.04, (2 - iz) / 2 - 0.04]
+        fig_layout[f"xaxis{tpc + 1}"] = dict(
+            domain=x_domain, anchor=f"y{tpc + 1}", title=dict(text=f"z [{length_unit}]")
+        )
+        fig_layout[f"yaxis{tpc + 1}"] = dict(
+            domain=y_domain,
+            anchor=f"x{tpc + 1}",
+            title=dict(text=f"y [{length_unit}]") if ix == 0 else None,
+            showticklabels=ix == 0,
+        )
+    return dict(data=traces, layout=fig_layout)
+
+
+def plot_light_integrals(light_hist):
+    """Plot the distribution of the light integral of every optical detector"""
+    centers = (LIGHT_INTEGRAL_BINS[:-1] + LIGHT_INTEGRAL_BINS[1:]) / 2
+    trace = dict(
+        type="heatmap",
+        x=np.arange(len(light_hist)),
+        y=centers,
+        z=light_hist.T,
+        colorscale=COLORSCALE,
+        colorbar=dict(title=dict(text="Light events")),
+        hovertemplate="opid %{x}<br>log10 integral %{y:.2f}<br>%{z} light events<extra></extra>",
+    )
+    layout = dict(
+        title=dict(text="Light integral per optical detector"),
+        xaxis=dict(title=dict(text="Optical detector")),
+        yaxis=dict(title=dict(text="log10(integral [adc counts x ticks])")),
+    )
+    return dict(data=[trace], layout=layout)
+
+
+def plot_event_rate(edges, rate):
+    """Plot the rate of the charge events against time"""
+    trace = dict(
+        type="scatter",
+        x=(edges[:-1] * 1000).astype(np.int64).astype("datetime64[ms]").astype(str),
+        y=rate,
+        mode="lines",
+        line=dict(shape="hv"),
+        hovertemplate="%{x}<br>%{y:.2f} Hz<extra></extra>",
+    )
+    layout = dict(
+        title=dict(text=f"Event rate ({EVENT_RATE_BIN} s bins)"),
+        xaxis=dict(title=dict(text="Time (UTC)")),
+        yaxis=dict(title=dict(text="Rate [Hz]")),
+    )
+    return dict(data=[trace], layout=layout)
+
+
+def plot_charge_light(hist):
+    """Plot the charge of the events against the light matched to them"""
+    trace = dict(
+        type="heatmap",
+        x=(LIGHT_BINS[:-1] + LIGHT_BINS[1:]) / 2,
+        y=(CHARGE_BINS[:-1] + CHARGE_BINS[1:]) / 2,
+        z=np.where(hist > 0, hist, np.nan),
+        colorscale=COLORSCALE,
+        colorbar=dict(title=dict(text="Events")),
+        hovertemplate="log10 light %{x:.2f}<br>log10 charge %{y:.2f}<br>%{z} events<extra></extra>",
+    )
+    layout = dict(
+        title=dict(text="Charge against light"),
+        xaxis=dict(title=dict(text="log10(light integral [adc counts x ticks])")),
+        yaxis=dict(title=dict(text="log10(prompt hit energy [MeV])")),
+    )
+    return dict(data=[trace], layout=layout)
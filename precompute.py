@@ -0,0 +1,52 @@
+"""
+Precompute the tables the app keeps next to a flow file (light matches, waveform
+features, the event summary and the run overview), e.g. once a run is written, so
+opening it is fast.
+Run with:
+``python precompute.py FILE [FILE ...]``
+"""
+import argparse
+import sys
+
+from display_utils import compute_light_features, get_light_match_table
+from file_utils import FILE_POOL
+from overview_utils import OVERVIEW_WORKERS, get_executor, get_run_overview
+from summary_utils import get_event_summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("filenames", nargs="+", help="flow files to precompute the tables of")
+    parser.add_argument(
+        "--skip-light-features",
+        action="store_true",
+        help="don't compute the waveform features and the run overview, "
+        "which read all the waveforms",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=OVERVIEW_WORKERS,
+        help="number of processes the waveform features and the run overview are computed with",
+    )
+    args = parser.parse_args(argv)
+
+    failed = []
+    for filename in args.filenames:
+        try:
+            get_light_match_table(filename)
+            get_event_summary(filename)
+            if not args.skip_light_features:
+                with get_executor(args.workers) as executor:
+                    compute_light_features(filename, executor)
+                get_run_overview(filename, args.workers)
+        except Exception as err:
+            print(f"Could not precompute the tables of {filename} : {err}")
+            failed.append(filename)
+        finally:
+            FILE_POOL.close(filename)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Render event displays from a flow file without the app, e.g. for run summaries.
+The events are spread over several processes, each with its own open file. Run with:
+``python render.py FILE --events 0:100 --format png --workers 8``
+"""
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import plotly.io as pio
+
+from display_utils import (
+    OPTIONAL_LAYERS,
+    create_3d_figure,
+    get_light_match_table,
+    parse_contents,
+    plot_waveform,
+)
+from file_utils import FILE_POOL, open_flow_file
+
+FORMATS = ["html", "json", "png"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("filename", help="flow file to render events from")
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument(
+        "--events",
+        help="events to render, as start:stop or a comma separated list (default: all)",
+    )
+    selection.add_argument(
+        "--event-list", help="file with the event IDs to render, one per line"
+    )
+    parser.add_argument("--format", choices=FORMATS, default="html")
+    parser.add_argument("--output-dir", default="renders")
+    parser.add_argument(
+        "--waveforms",
+        type=int,
+        nargs="*",
+        default=[],
+        metavar="OPID",
+        help="also render the light waveforms of these optical detectors",
+    )
+    parser.add_argument(
+        "--full-resolution",
+        action="store_true",
+        help="plot all hits instead of merging the hits of dense events into voxels",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    parser.add_argument(
+        "--chunk-size", type=int, default=16, help="number of events per job"
+    )
+    return parser.parse_args(argv)
+
+
+def select_events(args, num_events):
+    """Get the list of event IDs to render from the arguments"""
+    if args.event_list is not None:
+        with open(args.event_list) as f:
+            evids = [int(line) for line in f if line.strip()]
+    elif args.events is None:
+        evids = list(range(num_events))
+    elif ":" in args.events:
+        start, stop = args.events.split(":")
+        evids = list(range(int(start or 0), int(stop or num_events)))
+    else:
+        evids = [int(evid) for evid in args.events.split(",")]
+
+    out_of_range = [evid for evid in evids if not 0 <= evid < num_events]
+    if out_of_range:
+        print(f"Skipping events that are not in the file: {out_of_range}")
+    return [evid for evid in evids if 0 <= evid < num_events]
+
+
+def write_figure(fig, path, fmt):
+    if fmt == "html":
+        pio.write_html(fig, path, include_plotlyjs="cdn", validate=False)
+    elif fmt == "json":
+        pio.write_json(fig, path, validate=False)
+    elif fmt == "png":
+        pio.write_image(fig, path, format="png", validate=False)
+
+
+def render_events(filename, evids, output_dir, fmt, opids, full_resolution):
+    """
+    Render a list of events, runs in a worker process.
+    Returns the event IDs that could not be rendered.
+    """
+    failed = []
+    stem = Path(filename).stem
+    with open_flow_file(filename) as data:
+        for evid in evids:
+            try:
+                fig = create_3d_figure(
+                    data, evid, full_resolution=full_resolution, layers=OPTIONAL_LAYERS
+                )
+                write_figure(fig, Path(output_dir) / f"{stem}_evid{evid}.{fmt}", fmt)
+                for opid in opids:
+                    fig = plot_waveform(data, evid, opid)
+                    if isinstance(fig, list):
+                        continue  # no light for this event
+                    path = Path(output_dir) / f"{stem}_evid{evid}_opid{opid}.{fmt}"
+                    write_figure(fig, path, fmt)
+            except Exception as err:
+                print(f"Could not render event {evid} : {err}")
+                failed.append(evid)
+    return failed
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    _, num_events = parse_contents(args.filename)
+    evids = select_events(args, num_events)
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    # match the light once, the workers then read the match table from the cache
+    get_light_match_table(args.filename)
+    # the workers open the file themselves, don't share the handle with them
+    FILE_POOL.close_all()
+
+    chunks = [
+        evids[start : start + args.chunk_size]
+        for start in range(0, len(evids), args.chunk_size)
+    ]
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [
+            executor.submit(
+                render_events,
+                args.filename,
+                chunk,
+                args.output_dir,
+                args.format,
+                args.waveforms,
+                args.full_resolution,
+            )
+            for chunk in chunks
+        ]
+        for i, future in enumerate(as_completed(futures)):
+            failed.extend(future.result())
+            print(f"Rendered {i + 1}/{len(chunks)} chunks of events")
+
+    print(f"Rendered {len(evids) - len(failed)}/{len(evids)} events to {args.output_dir}")
+    if failed:
+        print(f"Failed events: {sorted(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Utility functions for summarising all the events in a file, to find interesting events
+"""
+import functools
+
+import numpy as np
+
+from display_utils import (
+    get_children,
+    get_first_child,
+    get_light_match_table,
+    read_rows,
+)
+from file_utils import get_file_schema, load_sidecar, open_flow_file, save_sidecar, sidecar_path
+
+# number of events summarised at a time
+SUMMARY_CHUNK = 1024
+# bump when the columns of the summary change, so old sidecar files are not used
+SUMMARY_VERSION = 1
+
+
+@functools.lru_cache(maxsize=8)
+def get_event_summary(filename):
+    """
+    Get the summary of every event in a file as a dict of arrays: the number of prompt
+    hits, their total energy (GeV), their bounding box, the number of matched light
+    events and whether there is truth for the event. The summary is computed in one
+    pass over the prompt hits and stored as a sidecar file in the cache.
+    """
+    path = sidecar_path(filename, f"event_summary_v{SUMMARY_VERSION}.npz")
+    summary = load_sidecar(path)
+    if summary is not None:
+        return summary
+
+    print(f"Summarising the events in {filename}")
+    schema = get_file_schema(filename)
+    with open_flow_file(filename) as data:
+        num_events = data["charge/events/data"].shape[0]
+        hits_dset = data["charge/calib_prompt_hits/data"].fields(["x", "y", "z", "E"])
+        summary = {
+            "nhit": np.zeros(num_events, dtype=np.int64),
+            "E": np.zeros(num_events),
+            "bbox_min": np.full((num_events, 3), np.nan),
+            "bbox_max": np.full((num_events, 3), np.nan),
+            "n_light": np.zeros(num_events, dtype=np.int64),
+            "has_truth": np.zeros(num_events, dtype=bool),
+        }
+        for start in range(0, num_events, SUMMARY_CHUNK):
+            stop = min(start + SUMMARY_CHUNK, num_events)
+            event, hit = get_children(
+                data, "charge/events", "charge/calib_prompt_hits", start, stop
+            )
+            if len(hit) == 0:
+                continue
+            rows, inverse = np.unique(hit, return_inverse=True)
+            hits = read_rows(hits_dset, rows)[inverse]
+            summarise_hits(summary, event, hits)
+            if schema.has_truth:
+                packet = get_first_child(data, "charge/calib_prompt_hits", "charge/packets", rows)
+                segment = get_first_child(data, "charge/packets", schema.truth_dataset, packet)
+                summary["has_truth"][event[segment[inverse] >= 0]] = True
+
+    table = get_light_match_table(filename)
+    if table is not None:
+        summary["n_light"] = np.diff(table[0])
+
+    save_sidecar(path, **summary)
+    return summary
+
+
+def summarise_hits(summary, event, hits):
+    """Add the hits to the summary, event is the (sorted) event index of every hit"""
+    events, first = np.unique(event, return_index=True)
+    summary["nhit"][events] = np.diff(np.append(first, len(event)))
+    summary["E"][events] = np.add.reduceat(hits["E"], first)
+    coords = np.stack([hits[axis] for axis in "xyz"], axis=1)
+    summary["bbox_min"][events] = np.minimum.reduceat(coords, first, axis=0)
+    summary["bbox_max"][events] = np.maximum.reduceat(coords, first, axis=0)
+
+
+def select_events(summary, min_hits=None, min_energy=None, with_light=False, with_truth=False):
+    """
+    Get the mask of the events with at least min_hits prompt hits, a total energy of at
+    least min_energy (in MeV) and, if asked for, matched light and truth.
+    """
+    selected = np.ones(len(summary["nhit"]), dtype=bool)
+    if min_hits:
+        selected &= summary["nhit"] >= min_hits
+    if min_energy:
+        selected &= summary["E"] * 1000 >= min_energy
+    if with_light:
+        selected &= summary["n_light"] > 0
+    if with_truth:
+        selected &= summary["has_truth"]
+    return selected
+
+
+def find_next_event(selected, evid, step=1, wrap=True):
+    """
+    Get the first selected event after evid (step 1) or before it (step -1),
+    wrapping around the file unless wrap is False. Returns None if no event
+    is selected, or none is left before the end of the file without wrapping.
+    """
+    candidates = np.flatnonzero(selected)
+    if len(candidates) == 0:
+        return None
+    if step > 0:
+        i = np.searchsorted(candidates, evid, side="right")
+        if not wrap and i == len(candidates):
+            return None
+        return int(candidates[i % len(candidates)])
+    i = np.searchsorted(candidates, evid, side="left") - 1
+    if not wrap and i < 0:
+        return None
+    return int(candidates[i])
@@ -0,0 +1,197 @@
+"""
+Utility functions for measuring where the time goes in the app
+"""
+import contextvars
+import functools
+import logging
+import logging.handlers
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# number of callbacks kept in the timing log
+TIMING_LOG_SIZE = 200
+# the timing log is also written to this file when the EVD_TIMING_LOG environment variable is set
+TIMING_LOG_FILE = os.environ.get("EVD_TIMING_LOG")
+TIMING_LOG_FILE_BYTES = 10 * 1024**2
+# upper bounds (in s) of the histogram buckets of the metrics
+METRICS_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# spans of the callback that is running in this thread (None outside callbacks)
+_current_spans = contextvars.ContextVar("current_spans", default=None)
+_current_depth = contextvars.ContextVar("current_depth", default=0)
+
+
+class SpanStats:
+    """Thread-safe histograms of the span durations, in the Prometheus text format"""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._stats = {}  # (metric, name) -> [bucket counts, count, sum]
+        self._lock = threading.Lock()
+
+    def add(self, metric, name, duration):
+        with self._lock:
+            stats = self._stats.setdefault(
+                (metric, name), [[0] * len(self.buckets), 0, 0.0]
+            )
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    stats[0][i] += 1
+            stats[1] += 1
+            stats[2] += duration
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+    def snapshot(self):
+        """A copy of the histograms, as {(metric, name): (bucket counts, count, sum)}"""
+        with self._lock:
+            return {
+                key: (list(counts), count, total)
+                for key, (counts, count, total) in self._stats.items()
+            }
+
+
+def spans_to_prometheus(snapshots, buckets=METRICS_BUCKETS):
+    """
+    The span histograms of several processes, as {process: SpanStats.snapshot()},
+    in the Prometheus text format with every metric family once
+    """
+    lines = []
+    metrics = sorted({metric for snapshot in snapshots.values() for metric, _ in snapshot})
+    for metric in metrics:
+        label = "span" if metric == "evd_span_seconds" else "callback"
+        lines.append(f"# TYPE {metric} histogram")
+        for process, snapshot in snapshots.items():
+            for (m, name), (counts, count, total) in sorted(snapshot.items()):
+                if m != metric:
+                    continue
+                labels = f'process="{process}",{label}="{name}"'
+                for bound, n in zip(buckets, counts):
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {n}')
+                lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f"{metric}_sum{{{labels}}} {total:.6f}")
+                lines.append(f"{metric}_count{{{labels}}} {count}")
+    return "\n".join(lines) + "\n"
+
+
+SPAN_STATS = SpanStats()
+TIMING_LOG = deque(maxlen=TIMING_LOG_SIZE)
+
+_logger = logging.getLogger("evd.timing")
+if TIMING_LOG_FILE:
+    _handler = logging.handlers.RotatingFileHandler(
+        TIMING_LOG_FILE, maxBytes=TIMING_LOG_FILE_BYTES, backupCount=2
+    )
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    _logger.addHandler(_handler)
+    _logger.setLevel(logging.INFO)
+    _logger.propagate = False
+
+
+@contextmanager
+def span(name):
+    """
+    Time a stage of the work, e.g. ``with span("hit reads"):``. The duration is added
+    to the metrics, and to the timings of the callback when called from one.
+    """
+    spans = _current_spans.get()
+    depth = _current_depth.get()
+    token = _current_depth.set(depth + 1)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        _current_depth.reset(token)
+        SPAN_STATS.add("evd_span_seconds", name, duration)
+        if spans is not None:
+            spans.append((start, depth, name, duration))
+
+
+@contextmanager
+def collect_spans():
+    """
+    Collect the spans of the work in the context outside of a callback, e.g. of a
+    request to the data service. The start of the spans is relative to the context.
+    """
+    spans = []
+    spans_token = _current_spans.set(spans)
+    depth_token = _current_depth.set(0)
+    start = time.perf_counter()
+    try:
+        yield spans
+    finally:
+        _current_spans.reset(spans_token)
+        _current_depth.reset(depth_token)
+        spans[:] = [(s - start, depth, name, d) for s, depth, name, d in spans]
+
+
+def add_spans(spans, start):
+    """
+    Add spans collected in another process (see collect_spans) to the callback
+    that is running, as if their context started at start. They are not added to
+    the metrics, the other process has them.
+    """
+    current = _current_spans.get()
+    if current is None:
+        return
+    depth = _current_depth.get()
+    current.extend((start + s, depth + d, name, duration) for s, d, name, duration in spans)
+
+
+def timed_callback(function):
+    """
+    Decorator for Dash callbacks, collects the spans of the callback and adds
+    them with the total duration to the timing log.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        spans = []
+        spans_token = _current_spans.set(spans)
+        depth_token = _current_depth.set(0)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            _current_spans.reset(spans_token)
+            _current_depth.reset(depth_token)
+            record_callback(function.__name__, duration, spans)
+
+    return wrapper
+
+
+def record_callback(name, duration, spans):
+    SPAN_STATS.add("evd_callback_seconds", name, duration)
+    entry = {
+        "callback": name,
+        "time": time.time(),
+        "duration": duration,
+        # in the order the spans started, nested spans after their parent
+        "spans": [(depth, span_name, d) for _, depth, span_name, d in sorted(spans)],
+    }
+    TIMING_LOG.append(entry)
+    if TIMING_LOG_FILE:
+        _logger.info(
+            "%s %.1f ms %s",
+            name,
+            1000 * duration,
+            " ".join(f"{span_name}={1000 * d:.1f}ms" for _, span_name, d in entry["spans"]),
+        )
+
+
+def format_timings(n=10):
+    """The timings of the last n callbacks as text, the most recent first"""
+    lines = []
+    for entry in list(TIMING_LOG)[::-1][:n]:
+        clock = time.strftime("%H:%M:%S", time.localtime(entry["time"]))
+        lines.append(f"{clock} {entry['callback']}: {1000 * entry['duration']:.1f} ms")
+        for depth, name, duration in entry["spans"]:
+            lines.append(f"{'  ' * (depth + 1)}{name}: {1000 * duration:.1f} ms")
+    return "\n".join(lines) or "No callbacks timed yet"
@@ -0,0 +1,76 @@
+"""
+Utility functions for analysing the light waveforms
+"""
+from collections import namedtuple
+
+import numpy as np
+
+# the first samples of the waveforms are before the trigger, their mean is the baseline
+BASELINE_SAMPLES = 50
+# ADC value at which a channel saturates
+SATURATION_ADC = 32767
+
+# per light event and channel: the baseline, the integral above the baseline, the peak
+# amplitude above the baseline and its sample, and whether the channel saturated
+WaveformFeatures = namedtuple(
+    "WaveformFeatures", ["baseline", "integral", "peak_amplitude", "peak_time", "saturated"]
+)
+
+
+def compute_waveform_features(waveforms, buffer=None, out=None):
+    """
+    Compute the features of (m, n_channels, n_samples) waveforms in one pass, in float32.
+    A float32 buffer of the same shape as the waveforms, and the output arrays
+    (see empty_features), can be passed in to reuse them between calls.
+    """
+    m, n_channels, n_samples = waveforms.shape
+    if buffer is None:
+        buffer = np.empty(waveforms.shape, dtype=np.float32)
+    if out is None:
+        out = empty_features(m, n_channels)
+
+    np.mean(waveforms[:, :, :BASELINE_SAMPLES], axis=2, dtype=np.float32, out=out.baseline)
+    np.subtract(waveforms, out.baseline[:, :, None], out=buffer, dtype=np.float32)
+    np.sum(buffer, axis=2, out=out.integral)
+    np.argmax(buffer, axis=2, out=out.peak_time)
+    out.peak_amplitude[...] = np.take_along_axis(buffer, out.peak_time[:, :, None], axis=2)[
+        :, :, 0
+    ]
+    # the peak is the maximum of the raw samples as well
+    np.greater_equal(out.peak_amplitude + out.baseline, SATURATION_ADC, out=out.saturated)
+    return out
+
+
+def empty_features(m, n_channels):
+    """Preallocate the features of m light events"""
+    return WaveformFeatures(
+        baseline=np.empty((m, n_channels), dtype=np.float32),
+        integral=np.empty((m, n_channels), dtype=np.float32),
+        peak_amplitude=np.empty((m, n_channels), dtype=np.float32),
+        peak_time=np.empty((m, n_channels), dtype=np.intp),
+        saturated=np.empty((m, n_channels), dtype=bool),
+    )
+
+
+def decimate_minmax(waveforms, n_buckets):
+    """
+    Decimate (n_channels, n_samples) waveforms for plotting by keeping the minimum and
+    maximum of every bucket of samples, in the order they occur, so the peaks are kept.
+    Returns the sample numbers and the values, both (n_channels, ~2 * n_buckets).
+    """
+    n_channels, n_samples = waveforms.shape
+    if n_samples <= 2 * n_buckets:
+        return np.broadcast_to(np.arange(n_samples), waveforms.shape), waveforms
+
+    bucket_size = -(-n_samples // n_buckets)  # rounded up
+    n_buckets = -(-n_samples // bucket_size)
+    # pad with the last sample so every bucket is full
+    padded = np.pad(waveforms, ((0, 0), (0, n_buckets * bucket_size - n_samples)), mode="edge")
+    buckets = padded.reshape(n_channels, n_buckets, bucket_size)
+    i_min = np.argmin(buckets, axis=2)
+    i_max = np.argmax(buckets, axis=2)
+    # (n_channels, n_buckets, 2) indices within the buckets, in time order
+    index = np.stack([np.minimum(i_min, i_max), np.maximum(i_min, i_max)], axis=2)
+    values = np.take_along_axis(buckets, index, axis=2).reshape(n_channels, -1)
+    samples = (np.arange(n_buckets)[None, :, None] * bucket_size + index).reshape(n_channels, -1)
+    return np.minimum(samples, n_samples - 1), values